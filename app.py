@@ -1,10 +1,40 @@
-from flask import Flask, render_template, request, redirect, url_for, session, abort, send_from_directory, flash, jsonify, Response, Blueprint
+from flask import Flask, render_template, request, redirect, url_for, session, abort, send_from_directory, flash, jsonify, Response, Blueprint, make_response
 from flask_login import LoginManager, login_user, login_required, current_user, logout_user
 from db import *
+from security import HashingBusy, login_throttle, login_ip_throttle
+from fragments import fragment_cache
+import assets
+import compression
+import history
+import ledger
+import live
+import metrics
+import scheduler
+import click
+import datetime
+import functools
+import hashlib
+import io
+import jdatetime
 import os
+import re
 import sys
+from pathlib import Path
+from werkzeug.middleware.proxy_fix import ProxyFix
 
 app = Flask(__name__)
+init_app(app)
+metrics.init_app(app)
+assets.init_app(app)
+compression.init_app(app)
+
+# Number of reverse proxies in front of the app (e.g. 1 behind nginx). Their
+# X-Forwarded-For/-Proto/-Host headers are then trusted, so the login throttle sees
+# client addresses and team routing the original host. Keep 0 when clients connect
+# directly: otherwise anyone could pick the address they are throttled by.
+TRUSTED_PROXIES = int(os.getenv("TRUSTED_PROXIES", "0"))
+if TRUSTED_PROXIES:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXIES, x_proto=TRUSTED_PROXIES, x_host=TRUSTED_PROXIES)
 
 login_manager = LoginManager()
 login_manager.login_view = "login"
@@ -12,9 +42,40 @@ login_manager.init_app(app)
 app.secret_key = "ferdowsi"
 
 
+def _build_id():
+    """
+    Hash of every module, migration, template and static file, so a deploy that
+    changes any of them (and with them the pages or their asset URLs) invalidates old ETags.
+    """
+    root = Path(app.root_path)
+    paths = sorted([*root.glob("*.py"), *root.glob("migrations/*.sql"), root / "schema.sql",
+                    *(p for d in ("templates", app.static_folder) for p in (root / d).rglob("*") if p.is_file())])
+    digest = hashlib.sha1()
+    for path in paths:
+        digest.update(str(path.relative_to(root)).encode())
+        digest.update(path.read_bytes())
+    return digest.hexdigest()[:8]
+
+BUILD_ID = os.getenv("BUILD_ID") or _build_id()
+
 @login_manager.user_loader
 def load_user(user_id):
-    return User.get_by_id(user_id)
+    try:
+        user = User.get_identity(user_id)
+    except LookupError:
+        return None
+    if not user.is_active:
+        return None  # deactivated: the session no longer signs anyone in
+    set_actor(user.id)  # lunch_ledger entries name who made the request's changes
+    return user
+
+@app.errorhandler(HashingBusy)
+def hashing_busy(e):
+    return Response(str(e), status=503, headers={"Retry-After": "1"})
+
+@app.errorhandler(live.StreamsFull)
+def streams_full(e):
+    return Response(str(e), status=503, headers={"Retry-After": "60"})
 # AUTHENTICATION
 
 @app.route("/account/login", methods=["GET", "POST"])
@@ -23,6 +84,10 @@ def login():
         return render_template("login.html")
     
     form = request.form
+    if not (login_ip_throttle.allow(request.remote_addr)
+            and login_throttle.allow(f"user:{form['username']}")):
+        flash("Too many login attempts. Please wait a minute and try again.")
+        return render_template("login.html", form=form), 429
     try:
         user = User.get_by_name(form["username"])
     except:
@@ -44,7 +109,11 @@ def logout():
     if request.method == "GET":
         return render_template("logout.html")
     logout_user()
-    return redirect(url_for("index"))
+    response = redirect(url_for("index"))
+    # The lunch page's queued actions (localStorage) and offline copies (service
+    # worker cache) belong to this user, not the next one to use the browser
+    response.headers["Clear-Site-Data"] = '"cache", "storage"'
+    return response
     
 
 @app.route("/account/register", methods=["GET", "POST"])
@@ -53,6 +122,9 @@ def register():
         return render_template("register.html")
 
     form = request.form
+    if not login_throttle.allow(f"register:{request.remote_addr}"):
+        flash("Too many attempts. Please wait a minute and try again.")
+        return render_template("register.html", form=form), 429
     name = form["username"].strip()
     display_name = form["displayname"].strip()
     password = form["password"].strip()
@@ -80,7 +152,7 @@ def change_password():
     old_pass, new_pass = form["old_password"], form["new_password1"]
     if current_user.authenticate(old_pass):
         current_user.set_password(new_pass)
-        current_user.update()
+        current_user.update_password()
         return redirect(url_for("index"))
     else:
         flash("Incorrect password")
@@ -95,13 +167,39 @@ def favicon():
     return send_from_directory(os.path.join(app.root_path, 'static'),
                                'favicon.ico', mimetype='image/vnd.microsoft.icon')
 
+def _user_directory_page():
+    """Shared by the user directory page and API. Returns (filters, users, previous_id, next_id)."""
+    filters = {"q": request.args.get("q", "").strip() or None,
+               "before": request.args.get("before", type=int),
+               "after": request.args.get("after", type=int)}
+    limit = min(max(request.args.get("limit", 50, type=int), 1), 200)
+
+    users, has_more = User.list_page(filters["q"], filters["before"], filters["after"], limit)
+    # Same cursor rules as _history_page(), with names ascending
+    paging_back = bool(filters["before"]) and not filters["after"]
+    previous_id = users[0].id if users and (filters["after"] or (paging_back and has_more)) else None
+    next_id = users[-1].id if users and (has_more or paging_back) else None
+    return filters, users, previous_id, next_id
+
 @app.route("/admin/users")
 @login_required
 def list_users():
     if not "admin" in current_user.role:
         return abort(403)
-    users = User.list_all()
-    return render_template("users.html", users=users)
+    filters, users, previous_id, next_id = _user_directory_page()
+    return render_template("users.html", filters=filters, users=users, previous_id=previous_id, next_id=next_id)
+
+@app.route("/api/admin/users")
+@login_required
+def list_users_api():
+    """?q= searches name and display name by word prefix; page with ?after= / ?before= user ids."""
+    if not "admin" in current_user.role:
+        return abort(403)
+    filters, users, previous_id, next_id = _user_directory_page()
+    return jsonify(users=[{"id": u.id, "name": u.name, "display_name": u.display_name,
+                           "role": u.role, "active": u.is_active} for u in users],
+                   previous=previous_id,
+                   next=next_id)
 
 @app.route("/admin/activate/<int:user_id>", methods=["POST"])
 @login_required
@@ -142,7 +240,7 @@ def promote_user(user_id):
         flash("User not found")
         return abort("409")
     e.role = "admin"
-    e.update()
+    e.update()  # also drops the cached identity
     return redirect(url_for("list_users"))
 
 @app.route("/admin/reset-password/<int:user_id>", methods=["POST"])
@@ -173,62 +271,459 @@ def admin_settings():
         return abort(403)
     return render_template("admin_settings.html")
 
+@app.route("/admin/history/import", methods=["POST"])
+@login_required
+def import_history():
+    """Accepts a CSV/JSONL upload (field "file") or a raw body; ?format= overrides the guess."""
+    if not "admin" in current_user.role:
+        return abort(403)
+    upload = request.files.get("file")
+    if upload:
+        stream, fmt = upload.stream, request.args.get("format") or history.guess_format(upload.filename)
+    else:
+        stream, fmt = request.stream, request.args.get("format", "csv")
+    if fmt not in history.FORMATS:
+        return jsonify(error=f"format must be one of {history.FORMATS}"), 400
+
+    text = io.TextIOWrapper(stream, encoding="utf-8-sig", newline="")
+    try:
+        summary = LunchEvent.import_records(history.read_records(text, fmt))
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+    return jsonify(summary)
+
+@app.route("/admin/history/export")
+@login_required
+def export_history():
+    if not "admin" in current_user.role:
+        return abort(403)
+    fmt = request.args.get("format", "csv")
+    if fmt not in history.FORMATS:
+        return jsonify(error=f"format must be one of {history.FORMATS}"), 400
+    return Response(history.write_records(LunchEvent.iter_history(), fmt),
+                    mimetype=history.MIMETYPES[fmt],
+                    headers={"Content-Disposition": f"attachment; filename=lunch-history.{fmt}"})
+
+@app.route("/api/admin/ledger")
+@login_required
+def ledger_api():
+    """Attendance and payer changes, newest first. Page with ?before=<seq>."""
+    if not "admin" in current_user.role:
+        return abort(403)
+    limit = min(max(request.args.get("limit", 50, type=int), 1), 500)
+    entries, has_more = ledger.entries(request.args.get("before", type=int), limit)
+    return jsonify(entries=entries, before=entries[-1]["seq"] if has_more else None)
+
+_today = (None, None)
+
+def jalali_today():
+    """Today's Jalali date as YYYY-MM-DD, converted once per Gregorian day."""
+    global _today
+    gregorian, jalali = _today
+    if gregorian != datetime.date.today():
+        gregorian = datetime.date.today()
+        jalali = jdatetime.date.fromgregorian(date=gregorian).strftime("%Y-%m-%d")
+        _today = (gregorian, jalali)
+    return jalali
+
+def versioned(view):
+    """
+    Conditional GETs for views that only depend on the lunch data: the ETag is
+    built from the data version, so a matching If-None-Match gets a 304 before
+    the view runs any of its queries.
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if request.method != "GET" or "_flashes" in session:
+            return view(*args, **kwargs)
+        etag = "-".join(str(part) for part in (
+            get_data_version(), jalali_today(), current_user.get_id(), BUILD_ID
+        ))
+        if request.if_none_match.contains_weak(etag):
+            response = Response(status=304)
+        else:
+            response = make_response(view(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+        response.set_etag(etag, weak=True)
+        response.headers["Cache-Control"] = "private, no-cache"
+        return response
+    return wrapper
+
 # LUNCH TRACKING
 @app.route("/lunch", methods=["GET", "POST"])
 @login_required
+@versioned
 def lunch():
-    import jdatetime
-    today = jdatetime.date.today().strftime("%Y-%m-%d")
+    today = jalali_today()
     
     if request.method == "POST":
         action = request.form.get("action")
         event = LunchEvent.get_or_create_by_date(today)
         
-        if action == "toggle_attendance":
-            user_id = int(request.form.get("user_id"))
-            attendees = event.get_attendees()
-            attendee_ids = [a.id for a in attendees]
-            if user_id in attendee_ids:
-                event.remove_attendee(user_id)
-            else:
-                event.add_attendee(user_id)
-        elif action == "set_payer":
-            payer_id = int(request.form.get("payer_id"))
-            event.set_payer(payer_id)
+        try:
+            if action == "toggle_attendance":
+                user_id = int(request.form.get("user_id"))
+                present = request.form.get("present")
+                if present is None:
+                    event.toggle_attendee(user_id)
+                else:
+                    event.set_attendance(user_id, present == "1")
+            elif action == "set_payer":
+                payer_id = int(request.form.get("payer_id"))
+                event.set_payer(payer_id)
+        except (TypeError, ValueError) as e:  # missing or unknown user id
+            return abort(400, str(e))
         
         return redirect(url_for("lunch"))
     
-    # GET request
-    event = LunchEvent.get_by_date(today)
-    attendees = event.get_attendees() if event else []
-    attendee_ids = [a.id for a in attendees]
-    
-    all_users = User.list_all()
-    
-    # Calculate next payer
-    next_payer = None
-    next_payer_user = None
-    if attendee_ids:
-        next_payer = LunchEvent.get_next_payer(attendee_ids)
-        if next_payer:
-            next_payer_user = User.get_by_id(next_payer)
-    
-    # Get user stats for display
-    stats = LunchEvent.get_user_stats()
-    
-    # Recent events
-    recent_events = LunchEvent.list_recent(10)
-    
-    return render_template("lunch.html", 
-                           today=today,
-                           event=event,
-                           attendees=attendees,
-                           attendee_ids=attendee_ids,
-                           all_users=all_users,
-                           next_payer=next_payer,
-                           next_payer_user=next_payer_user,
-                           stats=stats,
-                           recent_events=recent_events)
+    # GET request. Versions are read before the data, so a fragment rendered
+    # from newer data than its key is never served for the newer versions.
+    versions = get_table_versions()
+    stats_key = fragment_cache.key("user_stats", versions)
+    recent_key = fragment_cache.key("recent_history", versions)
+    recent_html = fragment_cache.get(recent_key)
+    dashboard = LunchDashboard(today, recent_limit=0 if recent_html else 10)
+    context = dashboard.template_context()
+    context["user_stats_html"] = fragment_cache.get_or_render(
+        stats_key, lambda: render_template("_user_stats.html", **context))
+    context["recent_history_html"] = recent_html or fragment_cache.get_or_render(
+        recent_key, lambda: render_template("_recent_history.html", **context))
+    return render_template("lunch.html", **context)
+
+@app.route("/lunch/stream")
+@login_required
+def lunch_stream():
+    """Server-Sent Events with attendance and payer changes, see live.py."""
+    q = live.broadcaster.subscribe(current_shard().name)
+    return Response(live.broadcaster.stream(q), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.route("/api/lunch/forecast")
+@login_required
+@versioned
+def lunch_forecast():
+    """
+    The next n payers (default 5, at most 50) if the same people keep coming.
+    ?attendees=1,2,3 picks the roster, otherwise today's attendance is used.
+    """
+    today = jalali_today()
+    n = min(max(request.args.get("n", 5, type=int), 1), 50)
+    if request.args.get("attendees"):
+        try:
+            attendee_ids = [int(i) for i in request.args["attendees"].split(",")]
+        except ValueError:
+            return jsonify(error="attendees must be comma separated user ids"), 400
+    else:
+        event = LunchEvent.get_by_date(today)
+        attendee_ids = [a.id for a in event.get_attendees()] if event else []
+    return jsonify(date=today, attendees=attendee_ids,
+                   forecast=scheduler.default_scheduler.forecast(attendee_ids, n, today))
+
+@app.route("/api/lunch/attendance", methods=["PUT"])
+@login_required
+def set_lunch_attendance():
+    """
+    Sets a day's whole roster at once.
+    Body: {"date": "YYYY-MM-DD" (Jalali, default today), "attendees": [user ids], "payer_id": id or null (optional)}
+    """
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify(error="Expected a JSON object"), 400
+
+    try:
+        event_date = normalize_date(data.get("date") or jalali_today())
+    except ValueError:
+        return jsonify(error="date must be a Jalali YYYY-MM-DD string"), 400
+    if event_date != jalali_today() and not "admin" in current_user.role:
+        return jsonify(error="Only admins can change the roster of other days"), 403
+
+    attendees = data.get("attendees")
+    if not isinstance(attendees, list) or not all(isinstance(i, int) for i in attendees):
+        return jsonify(error="attendees must be a list of user ids"), 400
+
+    payer_id = data.get("payer_id", ...)
+    if payer_id is not ... and payer_id is not None and payer_id not in attendees:
+        return jsonify(error="payer_id must be one of the attendees"), 400
+
+    event = LunchEvent.get_or_create_by_date(event_date)
+    try:
+        added, removed = event.set_attendees(attendees, payer_id)
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+    return jsonify(date=event_date,
+                   attendees=sorted(set(attendees)),
+                   payer_id=event.payer_id,
+                   added=added,
+                   removed=removed)
+
+@app.route("/api/lunch/dashboard")
+@login_required
+@versioned
+def lunch_dashboard_api():
+    """Today's roster, payer and stats, in the shape lunch.js applies (cached by the service worker)."""
+    return jsonify(live.dashboard_data(LunchDashboard(jalali_today(), recent_limit=0)))
+
+MAX_QUEUED_ACTIONS = 200
+
+def _apply_action(action):
+    """One action from /api/lunch/actions. Raises ValueError if it's malformed, DuplicateAction if already applied."""
+    if not isinstance(action, dict):
+        raise ValueError("Each action must be an object")
+    key = action.get("key")
+    if not isinstance(key, str) or not 0 < len(key) <= 100:
+        raise ValueError("key must be a string of up to 100 characters")
+    try:
+        event_date = normalize_date(action.get("date"))
+    except ValueError:
+        raise ValueError("date must be a Jalali YYYY-MM-DD string")
+    if event_date != jalali_today() and not "admin" in current_user.role:
+        raise ValueError("Only admins can change other days")  # e.g. clicks queued on yesterday's page
+    kind = action.get("action")
+    user_id = action.get("user_id") if kind == "attendance" else action.get("payer_id")
+    if kind not in ("attendance", "payer") or not isinstance(user_id, int):
+        raise ValueError("action must be attendance (with user_id and present) or payer (with payer_id)")
+    try:
+        User.get_identity(user_id)  # before the event is created, so a bad action leaves nothing behind
+    except LookupError:
+        raise ValueError(f"Unknown user {user_id}")
+
+    event = LunchEvent.get_or_create_by_date(event_date)
+    with action_key(key):
+        if kind == "attendance":
+            event.set_attendance(user_id, bool(action.get("present")))
+        else:
+            event.set_payer(user_id)
+
+@app.route("/api/lunch/actions", methods=["POST"])
+@login_required
+def lunch_actions():
+    """
+    Applies attendance/payer actions queued by the lunch page, in order.
+    Body: {"actions": [{"key": unique id, "date": "YYYY-MM-DD", "action": "attendance", "user_id": id, "present": bool}
+                       or {"key", "date", "action": "payer", "payer_id": id}, ...]}
+    Each key is applied at most once, so a batch can be resent safely after a lost response.
+    Returns a status per key ("applied", "duplicate" or "error") and today's dashboard.
+    """
+    data = request.get_json(silent=True)
+    actions = data.get("actions") if isinstance(data, dict) else None
+    if not isinstance(actions, list) or len(actions) > MAX_QUEUED_ACTIONS:
+        return jsonify(error=f"Expected {{\"actions\": [...]}} with at most {MAX_QUEUED_ACTIONS} actions"), 400
+
+    results = []
+    for action in actions:
+        result = {"key": action.get("key") if isinstance(action, dict) else None, "status": "applied"}
+        try:
+            _apply_action(action)
+        except DuplicateAction:
+            result["status"] = "duplicate"
+        except ValueError as e:
+            result.update(status="error", error=str(e))
+        results.append(result)
+    return jsonify(results=results,
+                   dashboard=live.dashboard_data(LunchDashboard(jalali_today(), recent_limit=0)))
+
+@app.route("/sw.js")
+def service_worker():
+    """The lunch page's service worker, served from the root so it can cover /lunch."""
+    response = send_from_directory(app.static_folder, "js/sw.js", max_age=0)
+    response.headers["Cache-Control"] = "no-cache"
+    return response
+
+def _history_page():
+    """Shared by the history page and API. Returns (filters, events, older, newer) or raises ValueError."""
+    filters = {k: request.args.get(k) or None for k in ("before", "after", "start", "end")}
+    for key, value in filters.items():
+        if value:
+            try:
+                filters[key] = normalize_date(value)  # compared as strings, so 1399-1-1 won't do
+            except ValueError:
+                raise ValueError(f"{key} must be a Jalali YYYY-MM-DD date")
+    limit = min(max(request.args.get("limit", 20, type=int), 1), 100)
+
+    events, has_more = LunchEvent.list_page(limit=limit, **filters)
+    # Cursors for the neighbouring pages. Going back from an older page there is
+    # always something newer, and paging via after= always leaves older rows behind.
+    paging_newer = bool(filters["after"]) and not filters["before"]
+    older = events[-1].event_date if events and (has_more or paging_newer) else None
+    newer = events[0].event_date if events and (filters["before"] or (paging_newer and has_more)) else None
+    return filters, events, older, newer
+
+@app.route("/lunch/history")
+@login_required
+@versioned
+def lunch_history():
+    try:
+        filters, events, older, newer = _history_page()
+    except ValueError as e:
+        flash(str(e))
+        return redirect(url_for("lunch_history"))
+    return render_template("history.html", filters=filters, events=events, older=older, newer=newer)
+
+@app.route("/api/lunch/history")
+@login_required
+@versioned
+def lunch_history_api():
+    try:
+        filters, events, older, newer = _history_page()
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+    return jsonify(events=[{"date": e.event_date,
+                            "payer_id": e.payer_id,
+                            "payer_name": e.payer_name,
+                            "attendees": [{"id": u.id, "display_name": u.display_name} for u in e.attendees]}
+                           for e in events],
+                   older=older,
+                   newer=newer)
+
+PERIOD_RE = re.compile(r"^\d{4}(-\d{2})?$")
+
+def _report(period):
+    """Shared by the reports page and API: (period, rows, years, months of the period's year)."""
+    period = period or jalali_today()[:4]
+    if not PERIOD_RE.match(period):
+        raise ValueError("period must be a Jalali year (1403) or month (1403-05)")
+    periods = LunchEvent.list_periods()
+    years = [p for p in periods if len(p) == 4]
+    months = sorted(p for p in periods if len(p) == 7 and p.startswith(period[:4]))
+    return period, LunchEvent.get_period_report(period), years, months
+
+@app.route("/lunch/reports")
+@login_required
+@versioned
+def lunch_reports():
+    try:
+        period, rows, years, months = _report(request.args.get("period"))
+    except ValueError as e:
+        flash(str(e))
+        return redirect(url_for("lunch_reports"))
+    return render_template("reports.html", period=period, rows=rows, years=years, months=months)
+
+@app.route("/api/lunch/reports")
+@login_required
+@versioned
+def lunch_reports_api():
+    try:
+        period, rows, years, months = _report(request.args.get("period"))
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+    return jsonify(period=period, users=rows, years=years, months=months)
+
+# MAINTENANCE
+def startup(connections=1):
+    """
+    Process startup: brings the database schema up to date, then does the work
+    the first request would otherwise pay for: opening pooled connections and
+    compiling every template.
+    """
+    make_db()
+    warm_pool(connections)
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
+    jalali_today()
+
+@app.cli.command("migrate")
+def migrate_command():
+    """Apply pending schema migrations to every team's database."""
+    for team in list_teams():
+        print(f"{team}: schema version {make_db(get_shard(team))}.")
+
+@app.cli.command("create-team")
+@click.argument("name")
+def create_team_command(name):
+    """Create the database for a new team, served at NAME.<TEAM_DOMAIN>."""
+    try:
+        shard = create_team(name)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    print(f"Created {shard.path}.")
+
+@app.cli.command("team-stats")
+def team_stats_command():
+    """Lunch totals for every team, and across all of them."""
+    print(f"{'team':20} {'users':>6} {'lunches':>8} {'paid':>6} {'drinks':>7}  first       last")
+    totals = dict.fromkeys(("users", "lunches", "paid", "drinks"), 0)
+    for team in list_teams():
+        with use_shard(team):
+            summary = LunchEvent.summary()
+        release_connection()
+        for key in totals:
+            totals[key] += summary[key]
+        print(f"{team:20} {summary['users']:6} {summary['lunches']:8} {summary['paid']:6} {summary['drinks']:7}"
+              f"  {summary['first_date'] or '-':10}  {summary['last_date'] or '-'}")
+    print(f"{'all teams':20} {totals['users']:6} {totals['lunches']:8} {totals['paid']:6} {totals['drinks']:7}")
+
+@app.cli.command("rebuild-stats")
+@click.option("--from-ledger", is_flag=True, help="Use the ledger's totals instead of aggregating the lunch history.")
+@click.option("--full", is_flag=True, help="With --from-ledger, replay every entry instead of starting from the latest snapshot.")
+def rebuild_stats_command(from_ledger, full):
+    """Rebuild the user_lunch_stats table from the lunch history (or the ledger)."""
+    make_db()
+    count = ledger.rebuild_stats(full) if from_ledger else LunchEvent.rebuild_user_stats()
+    print(f"Rebuilt stats for {count} users.")
+
+@app.cli.command("backfill-rollups")
+def backfill_rollups_command():
+    """Rebuild the Jalali month/year rollups from the lunch history."""
+    make_db()
+    count = LunchEvent.rebuild_period_stats()
+    print(f"Wrote {count} period rows.")
+
+@app.cli.command("ledger-snapshot")
+def ledger_snapshot_command():
+    """Store the current per-user totals as a ledger snapshot."""
+    seq = ledger.snapshot()
+    print(f"Snapshot at ledger entry {seq}." if seq else "Nothing changed since the last snapshot.")
+
+@app.cli.command("verify-ledger")
+@click.option("--full", is_flag=True, help="Replay every entry instead of starting from the latest snapshot.")
+def verify_ledger_command(full):
+    """Check user_lunch_stats against the totals replayed from the ledger."""
+    mismatches = ledger.verify(full)
+    for user_id, (stored, replayed) in sorted(mismatches.items()):
+        print(f"user {user_id}: stored {stored}, ledger {replayed}")
+    if mismatches:
+        sys.exit(1)
+    print("Stats match the ledger.")
+
+@app.cli.command("prune-action-keys")
+@click.option("--days", default=30, show_default=True, help="Keep keys this recent.")
+def prune_action_keys_command(days):
+    """Forget the idempotency keys of old lunch page actions."""
+    print(f"Removed {prune_action_keys(days)} keys.")
+
+@app.cli.command("verify-stats")
+def verify_stats_command():
+    """Check user_lunch_stats against the lunch history."""
+    mismatches = LunchEvent.verify_user_stats()
+    for user_id, (stored, expected) in sorted(mismatches.items()):
+        print(f"user {user_id}: stored {stored}, expected {expected}")
+    if mismatches:
+        sys.exit(1)
+    print("Stats are consistent.")
+
+@app.cli.command("import-history")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--format", "fmt", type=click.Choice(history.FORMATS), help="Defaults to the file extension.")
+@click.option("--batch-size", default=1000, show_default=True, help="Days per transaction.")
+def import_history_command(path, fmt, batch_size):
+    """Import lunch history from a CSV or JSONL file."""
+    fmt = fmt or history.guess_format(path)
+    with open(path, encoding="utf-8-sig", newline="") as f:
+        summary = LunchEvent.import_records(history.read_records(f, fmt), batch_size)
+    for line_no, reason in summary["skipped"]:
+        print(f"line {line_no}: skipped, {reason}")
+    print(f"Imported {summary['events']} days and {summary['attendance']} attendance rows.")
+
+@app.cli.command("export-history")
+@click.argument("path", type=click.Path(dir_okay=False, writable=True, allow_dash=True), default="-")
+@click.option("--format", "fmt", type=click.Choice(history.FORMATS), default="csv", show_default=True)
+def export_history_command(path, fmt):
+    """Export lunch history as CSV or JSONL (to stdout by default)."""
+    with click.open_file(path, "w", encoding="utf-8") as f:
+        for chunk in history.write_records(LunchEvent.iter_history(), fmt):
+            f.write(chunk)
 
 if __name__ == "__main__":
+    startup()
     app.run(host="0.0.0.0", port=2000)
@@ -0,0 +1,39 @@
+"""
+Fingerprinted static assets.
+
+Templates link shared CSS/JS with asset_url("css/base.css"), which appends a
+hash of the file's contents (?v=...). Requests carrying the current hash are
+served as immutable for a year; a changed file gets a new URL, so browsers
+never need to revalidate.
+"""
+import hashlib, os
+from flask import request, url_for
+
+ASSET_MAX_AGE = 365 * 24 * 3600
+
+
+def init_app(app):
+    fingerprints = {}
+
+    def fingerprint(filename):
+        if filename not in fingerprints or app.debug:
+            with open(os.path.join(app.static_folder, filename), "rb") as f:
+                fingerprints[filename] = hashlib.sha1(f.read()).hexdigest()[:10]
+        return fingerprints[filename]
+
+    def asset_url(filename):
+        return url_for("static", filename=filename, v=fingerprint(filename))
+
+    app.jinja_env.globals["asset_url"] = asset_url
+
+    @app.after_request
+    def cache_assets(response):
+        if request.endpoint == "static" and response.status_code == 200:
+            version = request.args.get("v")
+            try:
+                current = version and fingerprint(request.view_args["filename"])
+            except OSError:
+                current = None
+            if version and version == current:
+                response.headers["Cache-Control"] = f"public, max-age={ASSET_MAX_AGE}, immutable"
+        return response
@@ -0,0 +1,250 @@
+"""
+Performance benchmarks on a deterministic synthetic database.
+
+    python bench.py --users 40 --days 750 --output results.json
+    python bench.py --output new.json --compare results.json
+
+Builds a fresh database (same seed and end date -> same data), then times the Flask views
+through the test client and the User/LunchEvent methods directly, recording
+latency percentiles and SQL statements per call.
+"""
+import argparse, json, os, platform, random, sqlite3, statistics, subprocess, sys, tempfile, time
+from pathlib import Path
+
+BENCH_PASSWORD = "bench"
+
+
+class QueryCounter:
+    """Connection hook counting the statements a connection runs (ignoring PRAGMAs and transaction control)."""
+    SKIP = ("PRAGMA", "BEGIN", "COMMIT", "ROLLBACK", "--")
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, connection):
+        connection.set_trace_callback(self._trace)
+
+    def _trace(self, statement):
+        if not statement.lstrip().upper().startswith(self.SKIP):
+            self.count += 1
+
+
+BENCH_END_DATE = "1403-12-28"
+
+
+def jalali_date(value):
+    """argparse type for --end-date: a Jalali YYYY-MM-DD date."""
+    import jdatetime
+    try:
+        return jdatetime.datetime.strptime(value, "%Y-%m-%d").date()
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"{value!r} is not a Jalali YYYY-MM-DD date")
+
+
+def generate(users, days, density, seed, end):
+    """
+    Fills the (empty, migrated) database with users, one lunch per working day
+    ending on the Jalali date end, and attendance where each user shows up with their own
+    probability around density. The payer is the attendee with the lowest
+    paid/drank ratio, like the app suggests.
+    """
+    import jdatetime
+    from db import get_connection
+    from security import hash_password
+
+    rng = random.Random(seed)
+    password = hash_password(BENCH_PASSWORD)
+    with get_connection() as conn:
+        conn.executemany(
+            "INSERT INTO users (name, display_name, role, password, active) VALUES (?, ?, ?, ?, 1)",
+            [(f"user{i}", f"User {i}", "archadmin" if i == 0 else "user", password) for i in range(users)]
+        )
+        user_ids = [r["id"] for r in conn.execute("SELECT id FROM users ORDER BY id")]
+        presence = {u: min(1.0, max(0.05, rng.gauss(density, 0.15))) for u in user_ids}
+        paid = dict.fromkeys(user_ids, 0)
+        drank = dict.fromkeys(user_ids, 0)
+
+        day = end - jdatetime.timedelta(days=days)
+        while day < end:
+            day += jdatetime.timedelta(days=1)
+            if day.weekday() == 6:  # Friday
+                continue
+            attendees = [u for u in user_ids if rng.random() < presence[u]]
+            payer = None
+            if attendees:
+                payer = min(attendees, key=lambda u: (paid[u] / drank[u] if drank[u] else 0, rng.random()))
+                paid[payer] += 1
+                for u in attendees:
+                    drank[u] += 1
+            event_id = conn.execute(
+                "INSERT INTO lunch_events (event_date, payer_id) VALUES (?, ?)",
+                [day.strftime("%Y-%m-%d"), payer]
+            ).lastrowid
+            conn.executemany(
+                "INSERT INTO lunch_attendance (lunch_event_id, user_id) VALUES (?, ?)",
+                [(event_id, u) for u in attendees]
+            )
+        conn.execute("ANALYZE")
+    return user_ids
+
+
+def measure(fn, counter, iterations, warmup=3):
+    for _ in range(warmup):
+        fn()
+    timings, queries = [], []
+    for _ in range(iterations):
+        before = counter.count
+        start = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - start) * 1000)
+        queries.append(counter.count - before)
+    timings.sort()
+
+    def pct(p):
+        return timings[min(len(timings) - 1, int(round(p / 100 * (len(timings) - 1))))]
+
+    return {
+        "n": iterations,
+        "mean_ms": round(statistics.fmean(timings), 3),
+        "p50_ms": round(pct(50), 3),
+        "p90_ms": round(pct(90), 3),
+        "p99_ms": round(pct(99), 3),
+        "max_ms": round(timings[-1], 3),
+        "queries_per_call": round(statistics.fmean(queries), 2),
+    }
+
+
+def run(args):
+    import app as app_module
+    from db import User, LunchEvent, LunchDashboard, connection_hooks
+
+    counter = QueryCounter()
+    connection_hooks.append(counter)
+
+    app_module.startup()
+    user_ids = generate(args.users, args.days, args.density, args.seed, args.end_date)
+    today = args.end_date.strftime("%Y-%m-%d")  # the generated data's "today", not the calendar's
+    attendees = LunchEvent.get_by_date(today)
+    attendee_ids = [a.id for a in attendees.get_attendees()] if attendees else user_ids[:5]
+
+    app = app_module.app
+    app.config["TESTING"] = True
+    client = app.test_client()
+
+    def check(response, *expected):
+        if response.status_code not in expected:
+            raise RuntimeError(f"{response.request.path} returned {response.status_code}")
+
+    def login():
+        with app.test_client() as c:
+            check(c.post("/account/login", data={"username": "user0", "password": BENCH_PASSWORD}), 302)
+
+    check(client.post("/account/login", data={"username": "user0", "password": BENCH_PASSWORD}), 302)
+    toggles = {"present": "1"}
+
+    def post_lunch():
+        toggles["present"] = "0" if toggles["present"] == "1" else "1"
+        check(client.post("/lunch", data={"action": "toggle_attendance", "user_id": user_ids[-1], **toggles}), 302)
+
+    # The 21 oldest days, newest first. Paging before the first of them gives the very
+    # last page of history, to check deep pages cost the same as the first.
+    oldest = LunchEvent.list_page(after="0000-00-00", limit=21)[0]
+    benchmarks = {
+        "GET /lunch": lambda: check(client.get("/lunch"), 200),
+        "POST /lunch toggle": post_lunch,
+        "GET /admin/users": lambda: check(client.get("/admin/users"), 200),
+        "GET /api/lunch/history": lambda: check(client.get("/api/lunch/history"), 200),
+        "POST /account/login": login,
+        "User.get_by_id": lambda: User.get_by_id(user_ids[0]),
+        "User.get_identity": lambda: User.get_identity(user_ids[0]),
+        "User.list_all": User.list_all,
+        "User.list_page": User.list_page,
+        "User.list_page (search)": lambda: User.list_page("user1"),
+        "LunchEvent.get_user_stats": LunchEvent.get_user_stats,
+        "LunchEvent.get_next_payer": lambda: LunchEvent.get_next_payer(attendee_ids),
+        "LunchEvent.list_recent": lambda: LunchEvent.list_recent(10),
+        "LunchDashboard": lambda: LunchDashboard(today),
+    }
+    if oldest:
+        benchmarks["LunchEvent.list_page (first)"] = lambda: LunchEvent.list_page()
+        benchmarks["LunchEvent.list_page (last)"] = lambda: LunchEvent.list_page(before=oldest[0].event_date)
+
+    results = {}
+    for name, fn in benchmarks.items():
+        if args.filter and args.filter not in name:
+            continue
+        iterations = max(1, args.iterations // 10) if "login" in name else args.iterations
+        results[name] = measure(fn, counter, iterations)
+        print(f"{name:32} p50 {results[name]['p50_ms']:8.3f} ms  p99 {results[name]['p99_ms']:8.3f} ms"
+              f"  {results[name]['queries_per_call']:6.2f} q/call", file=sys.stderr)
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=Path(__file__).parent).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def compare(results, baseline_path):
+    baseline = json.loads(Path(baseline_path).read_text())["results"]
+    print(f"\n{'benchmark':32} {'p50 before':>11} {'p50 after':>11} {'change':>8}  queries", file=sys.stderr)
+    for name, new in results.items():
+        old = baseline.get(name)
+        if not old:
+            continue
+        change = (new["p50_ms"] - old["p50_ms"]) / old["p50_ms"] * 100 if old["p50_ms"] else 0
+        print(f"{name:32} {old['p50_ms']:11.3f} {new['p50_ms']:11.3f} {change:+7.1f}%"
+              f"  {old['queries_per_call']:g} -> {new['queries_per_call']:g}", file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--users", type=int, default=30)
+    parser.add_argument("--days", type=int, default=365)
+    parser.add_argument("--density", type=float, default=0.6, help="Average chance a user attends a lunch.")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--end-date", type=jalali_date, default=BENCH_END_DATE,
+                        help=f"Jalali date of the last generated lunch (default {BENCH_END_DATE}), "
+                             "so runs on different days build the same database.")
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--filter", help="Only run benchmarks whose name contains this.")
+    parser.add_argument("--output", help="Write results as JSON here (default: stdout).")
+    parser.add_argument("--compare", help="Earlier results JSON to compare against.")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="lunch-bench-")
+    os.environ["DB_PATH"] = str(Path(workdir) / "bench.sqlite")
+    os.environ.setdefault("LOGIN_BURST", "1000000")
+    os.environ.setdefault("LOGIN_IP_BURST", "1000000")
+    sys.path.insert(0, str(Path(__file__).parent))
+
+    results = run(args)
+    report = {
+        "meta": {
+            "commit": git_commit(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "users": args.users,
+            "days": args.days,
+            "density": args.density,
+            "seed": args.seed,
+            "end_date": args.end_date.strftime("%Y-%m-%d"),
+            "iterations": args.iterations,
+        },
+        "results": results,
+    }
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        Path(args.output).write_text(text + "\n")
+    else:
+        print(text)
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
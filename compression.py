@@ -0,0 +1,54 @@
+"""
+gzip/brotli compression of HTML, JSON and other text responses.
+
+Brotli is used when the optional brotli package is installed and the client
+accepts it, gzip otherwise. Bodies under COMPRESS_MIN_SIZE bytes, streamed
+responses (SSE, exports) and files sent by send_file are left alone.
+"""
+import gzip, os
+from flask import request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESS_MIN_SIZE = int(os.getenv("COMPRESS_MIN_SIZE", "500"))
+COMPRESS_MIMETYPES = {"text/html", "application/json", "text/css", "text/javascript",
+                      "application/javascript", "text/plain", "text/csv"}
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5  # fast enough to do per request
+
+
+def _choose_encoding():
+    if brotli is not None and request.accept_encodings["br"]:
+        return "br"
+    if request.accept_encodings["gzip"]:
+        return "gzip"
+    return None
+
+
+def compress_response(response):
+    if (response.direct_passthrough or response.is_streamed
+            or response.status_code < 200 or response.status_code in (204, 304)
+            or "Content-Encoding" in response.headers
+            or response.mimetype not in COMPRESS_MIMETYPES):
+        return response
+    response.vary.add("Accept-Encoding")
+    body = response.get_data()
+    if len(body) < COMPRESS_MIN_SIZE:
+        return response
+    encoding = _choose_encoding()
+    if encoding is None:
+        return response
+    if encoding == "br":
+        body = brotli.compress(body, quality=BROTLI_QUALITY)
+    else:
+        body = gzip.compress(body, compresslevel=GZIP_LEVEL)
+    response.set_data(body)
+    response.headers["Content-Encoding"] = encoding
+    return response
+
+
+def init_app(app):
+    app.after_request(compress_response)
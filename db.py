@@ -1,10 +1,117 @@
-import sqlite3, os, jdatetime, bcrypt, random
+import sqlite3, os, re, jdatetime, bcrypt, threading, queue, time
+from collections import OrderedDict, namedtuple
+from concurrent.futures import Future
+from contextlib import contextmanager
 from pathlib import Path
+from security import hash_password, check_password, needs_rehash
+
+try:
+    import fcntl
+except ImportError:  # Windows: make_db() relies on its write transactions alone
+    fcntl = None
 
 DB_PATH = Path("instance/db.sqlite")
 if os.getenv("DB_PATH"):
     DB_PATH = Path(os.getenv("DB_PATH"))
 
+SCHEMA_PATH = Path(__file__).parent / "schema.sql"
+MIGRATIONS_DIR = Path(__file__).parent / "migrations"
+
+# Multi-team: each team has its own database TEAMS_DIR/<team>.sqlite, picked by
+# subdomain (<team>.<TEAM_DOMAIN>). The bare domain is the default team at DB_PATH.
+TEAMS_DIR = Path(os.getenv("TEAMS_DIR")) if os.getenv("TEAMS_DIR") else None
+TEAM_DOMAIN = os.getenv("TEAM_DOMAIN", "").lower()
+DEFAULT_TEAM = "default"
+TEAM_NAME_RE = re.compile(r"^[a-z0-9][a-z0-9-]{0,62}$")
+
+# Connections are reused across requests instead of reconnecting for every query.
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "8"))
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+DB_MMAP_SIZE = int(os.getenv("DB_MMAP_SIZE", str(64 * 1024 * 1024)))
+# With DB_WRITE_QUEUE=1 lunch writes go through one writer thread (see WriteQueue).
+DB_WRITE_QUEUE = os.getenv("DB_WRITE_QUEUE", "") == "1"
+WRITE_BATCH_SIZE = int(os.getenv("WRITE_BATCH_SIZE", "64"))
+
+# Session identities for Flask-Login. Each request still reads the Users table
+# version (one query); a cache hit saves only the users row read after it.
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "256"))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "60"))
+
+
+class IdentityCache:
+    """
+    Thread-safe LRU cache of user_id -> identity dict (id, name, display_name,
+    role, active). Never holds the password hash. Each entry is tagged with the
+    Users table version it was read at, and only served for that version, so
+    changes made by other processes show up too; the ttl only drops idle entries.
+    """
+    def __init__(self, maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id, version=None):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return None
+            expires, entry_version, identity = entry
+            if expires < time.monotonic() or entry_version != version:
+                del self._entries[user_id]
+                return None
+            self._entries.move_to_end(user_id)
+            return identity
+
+    def put(self, user_id, identity, version=None):
+        with self._lock:
+            self._entries[user_id] = (time.monotonic() + self.ttl, version, identity)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+
+def normalize_date(value):
+    """
+    value as the canonical Jalali YYYY-MM-DD string dates are stored and compared
+    as ("1402-1-5" -> "1402-01-05"). Raises ValueError if it isn't a Jalali date.
+    """
+    try:
+        d = jdatetime.datetime.strptime(value, "%Y-%m-%d")
+    except (TypeError, ValueError):
+        raise ValueError(f"{value!r} is not a Jalali YYYY-MM-DD date") from None
+    return f"{d.year:04d}-{d.month:02d}-{d.day:02d}"
+
+
+# Same mapping as the users_fts triggers (migrations/0007_user_directory.sql)
+SEARCH_NORMALIZE = str.maketrans({"\u064a": "\u06cc", "\u0643": "\u06a9", "\u200c": " "})
+
+def normalize_search(text):
+    return text.translate(SEARCH_NORMALIZE)
+
+def _match_expression(query):
+    """FTS5 query matching rows that contain every word of query as a prefix."""
+    words = normalize_search(query).split()
+    return " ".join('"' + w.replace('"', '""') + '"*' for w in words)
+
+
+class UserRow(namedtuple("UserRow", "id name display_name role active")):
+    """Read-only user directory entry. Never carries the password hash."""
+    __slots__ = ()
+
+    @property
+    def is_active(self):
+        return bool(self.active)
+
 class User:
     def __init__(self, id=-1, name="", display_name="", role="", password=""):
         self.id = id
@@ -19,9 +126,8 @@ class User:
 
     def set_password(self, password):
         if password:  # only hash if provided
-            salt = bcrypt.gensalt()
-            self.password = bcrypt.hashpw(password.encode("utf8"), salt)
-            
+            self.password = hash_password(password)
+
         else:
             self.password = None
 
@@ -70,6 +176,34 @@ class User:
         except sqlite3.DatabaseError as e:
             raise RuntimeError(f"Database error while fetching user by id: {e}") from e
 
+    @staticmethod
+    def get_identity(id):
+        """
+        Like get_by_id, but without the password column, and the users row comes from
+        the shard's identity cache when it is current. authenticate() still works on the
+        result; it fetches the hash on demand. Every call runs one query for the Users
+        table version, so a user deactivated or changed by another worker is re-read at once.
+        """
+        id = int(id)
+        try:
+            with get_connection() as conn:
+                version = conn.execute("SELECT version FROM table_versions WHERE name='Users'").fetchone()["version"]
+                identity = current_shard().identity_cache.get(id, version)
+                if identity is None:
+                    res = conn.execute(
+                        "SELECT id, name, display_name, role, active FROM users WHERE id=?", [id]
+                    ).fetchone()
+                    if not res:
+                        raise LookupError(f"No user found with id={id}")
+                    identity = dict(res)
+                    current_shard().identity_cache.put(id, identity, version)
+        except sqlite3.DatabaseError as e:
+            raise RuntimeError(f"Database error while fetching user identity: {e}") from e
+
+        e = User(identity["id"], identity["name"], identity["display_name"], identity["role"])
+        e._active = bool(identity["active"])
+        return e
+
     @staticmethod
     def get_by_name(name):
         try:
@@ -85,6 +219,12 @@ class User:
         except sqlite3.DatabaseError as e:
             raise RuntimeError(f"Database error while fetching user by name: {e}") from e
 
+    @staticmethod
+    def ids_by_name():
+        """name -> id for every user, for resolving names in bulk without a query each."""
+        with get_connection() as conn:
+            return {r["name"]: r["id"] for r in conn.execute("SELECT id, name FROM users")}
+
     @staticmethod
     def exists(q):
         with get_connection() as conn:
@@ -122,9 +262,9 @@ class User:
                     cur = conn.cursor()
                     cur.execute(
                         "UPDATE users SET name=?, display_name=?, role=?, password=?, active=? WHERE id=?",
-                        [self.name, self.display_name, self.role, self.password, self.is_active, self.email, self.id]
+                        [self.name, self.display_name, self.role, self.password, self.is_active, self.id]
                     )
-                    self.id = cur.lastrowid
+                    current_shard().identity_cache.invalidate(self.id)
                 else: 
                     raise RuntimeError(f"User {id} doesn't exists")
 
@@ -139,18 +279,21 @@ class User:
         with get_connection() as conn:
             conn.execute("UPDATE users SET active=1 WHERE id=?", [self.id])
             conn.commit()
-        self.active = 1
+        current_shard().identity_cache.invalidate(self.id)
+        self._active = True
 
     def deactivate(self):
         with get_connection() as conn:
             conn.execute("UPDATE users SET active=0 WHERE id=?", [self.id])
             conn.commit()
-        self.active = 0
+        current_shard().identity_cache.invalidate(self.id)
+        self._active = False
 
     def update_password(self):
         with get_connection() as conn:
             conn.execute("UPDATE users SET password=? WHERE id=?", [self.password, self.id])
             conn.commit()
+        current_shard().identity_cache.invalidate(self.id)
 
     @staticmethod
     def list_all():
@@ -164,11 +307,57 @@ class User:
                 users.append(e)
             return users
 
+    @staticmethod
+    def list_page(query=None, before=None, after=None, limit=50):
+        """
+        One page of the user directory as UserRows, ordered by name, using a user
+        id as the keyset cursor: pass the last id of a page as after= for the next
+        page, or the first id as before= for the previous one. query matches word
+        prefixes of name or display_name through the users_fts index.
+        Returns (users, has_more) where has_more says whether the page was cut at limit.
+        """
+        where, params = [], []
+        source = "Users u"
+        if query and _match_expression(query):
+            source = "users_fts JOIN Users u ON u.id = users_fts.rowid"
+            where.append("users_fts MATCH ?")
+            params.append(_match_expression(query))
+        if before:
+            where.append("(u.name, u.id) < (SELECT name, id FROM Users WHERE id = ?)")
+            params.append(before)
+        if after:
+            where.append("(u.name, u.id) > (SELECT name, id FROM Users WHERE id = ?)")
+            params.append(after)
+        order = "DESC" if before and not after else "ASC"
+
+        with get_connection() as conn:
+            rows = conn.execute(f"""
+                SELECT u.id, u.name, u.display_name, u.role, u.active
+                FROM {source}
+                {"WHERE " + " AND ".join(where) if where else ""}
+                ORDER BY u.name {order}, u.id {order}
+                LIMIT ?
+            """, [*params, limit + 1]).fetchall()
+        has_more = len(rows) > limit
+        users = [UserRow(*r) for r in rows[:limit]]
+        if order == "DESC":
+            users.reverse()
+        return users, has_more
+
     def authenticate(self, password):
         try:
+            if self.password is None and self.id != -1:
+                # Loaded through get_identity(), fetch the hash now
+                self.password = self.get_pass_hash()
             if not self.password:
                 return True
-            return bcrypt.checkpw(password.encode("utf8"), self.password)
+            if not check_password(password, self.password):
+                return False
+            if needs_rehash(self.password):
+                # BCRYPT_ROUNDS changed since this hash was made
+                self.set_password(password)
+                self.update_password()
+            return True
         except (ValueError, TypeError, bcrypt.error) as e:
             raise RuntimeError(f"Error during authentication: {e}") from e
 
@@ -183,13 +372,16 @@ class LunchEvent:
     def get_or_create_by_date(event_date):
         with get_connection() as conn:
             res = conn.execute("SELECT * FROM lunch_events WHERE event_date=?", [event_date]).fetchone()
-            if res:
-                return LunchEvent(res["id"], res["event_date"], res["payer_id"])
-            else:
-                cur = conn.cursor()
-                cur.execute("INSERT INTO lunch_events (event_date) VALUES (?)", [event_date])
-                conn.commit()
-                return LunchEvent(cur.lastrowid, event_date, None)
+        if res:
+            return LunchEvent(res["id"], res["event_date"], res["payer_id"])
+
+        def create(conn):
+            # Another writer may have created it since the SELECT above
+            conn.execute("INSERT INTO lunch_events (event_date) VALUES (?) ON CONFLICT (event_date) DO NOTHING",
+                         [event_date])
+            return conn.execute("SELECT * FROM lunch_events WHERE event_date=?", [event_date]).fetchone()
+        res = run_write(create)
+        return LunchEvent(res["id"], res["event_date"], res["payer_id"])
 
     @staticmethod
     def get_by_date(event_date):
@@ -207,23 +399,90 @@ class LunchEvent:
             return None
 
     def set_payer(self, user_id):
-        with get_connection() as conn:
-            conn.execute("UPDATE lunch_events SET payer_id=? WHERE id=?", [user_id, self.id])
-            conn.commit()
-        self.payer_id = user_id
+        try:
+            run_write(lambda conn: conn.execute("UPDATE lunch_events SET payer_id=? WHERE id=?", [user_id, self.id]))
+        except sqlite3.IntegrityError as e:
+            raise ValueError(f"Integrity error while setting payer: {e}") from e
+        previous, self.payer_id = self.payer_id, user_id
+        _notify_change("payer", self, payer_id=user_id, previous_payer_id=previous)
 
     def add_attendee(self, user_id):
-        with get_connection() as conn:
-            try:
-                conn.execute("INSERT INTO lunch_attendance (lunch_event_id, user_id) VALUES (?, ?)", [self.id, user_id])
-                conn.commit()
-            except sqlite3.IntegrityError:
-                pass  # Already exists
+        """Raises ValueError for an unknown user_id; already present is not an error."""
+        try:
+            added = run_write(lambda conn: conn.execute(
+                "INSERT INTO lunch_attendance (lunch_event_id, user_id) VALUES (?, ?) ON CONFLICT DO NOTHING",
+                [self.id, user_id]
+            ).rowcount)
+        except sqlite3.IntegrityError as e:
+            raise ValueError(f"Integrity error while adding attendee: {e}") from e
+        if not added:
+            return  # Already exists
+        _notify_change("attendance", self, user_id=user_id, present=True)
 
     def remove_attendee(self, user_id):
-        with get_connection() as conn:
-            conn.execute("DELETE FROM lunch_attendance WHERE lunch_event_id=? AND user_id=?", [self.id, user_id])
-            conn.commit()
+        removed = run_write(lambda conn: conn.execute(
+            "DELETE FROM lunch_attendance WHERE lunch_event_id=? AND user_id=?", [self.id, user_id]
+        ).rowcount)
+        if removed:
+            _notify_change("attendance", self, user_id=user_id, present=False)
+
+    def set_attendance(self, user_id, present):
+        """Idempotent: marks user_id present or absent whatever the current state."""
+        if present:
+            self.add_attendee(user_id)
+        else:
+            self.remove_attendee(user_id)
+
+    def toggle_attendee(self, user_id):
+        """Flips user_id's attendance without reading the roster first. Returns True if now present."""
+        def toggle(conn):
+            removed = conn.execute(
+                "DELETE FROM lunch_attendance WHERE lunch_event_id=? AND user_id=?", [self.id, user_id]
+            ).rowcount
+            if not removed:
+                conn.execute("INSERT INTO lunch_attendance (lunch_event_id, user_id) VALUES (?, ?)", [self.id, user_id])
+            return removed
+        try:
+            removed = run_write(toggle)
+        except sqlite3.IntegrityError as e:
+            raise ValueError(f"Integrity error while toggling attendee: {e}") from e
+        _notify_change("attendance", self, user_id=user_id, present=not removed)
+        return not removed
+
+    def set_attendees(self, user_ids, payer_id=...):
+        """
+        Makes the attendance exactly user_ids (and sets the payer, if given) in
+        one transaction. Returns (added, removed) as sorted lists of user ids.
+        """
+        desired = set(user_ids)
+
+        def replace(conn):
+            current = {r["user_id"] for r in conn.execute(
+                "SELECT user_id FROM lunch_attendance WHERE lunch_event_id=?", [self.id]
+            )}
+            added, removed = sorted(desired - current), sorted(current - desired)
+            conn.executemany(
+                "DELETE FROM lunch_attendance WHERE lunch_event_id=? AND user_id=?",
+                [(self.id, user_id) for user_id in removed]
+            )
+            conn.executemany(
+                "INSERT INTO lunch_attendance (lunch_event_id, user_id) VALUES (?, ?)",
+                [(self.id, user_id) for user_id in added]
+            )
+            if payer_id is not ...:
+                conn.execute("UPDATE lunch_events SET payer_id=? WHERE id=?", [payer_id, self.id])
+            return added, removed
+        try:
+            added, removed = run_write(replace)
+        except sqlite3.IntegrityError as e:
+            raise ValueError(f"Integrity error while setting attendees: {e}") from e
+        previous = self.payer_id
+        if payer_id is not ...:
+            self.payer_id = payer_id
+        if added or removed or self.payer_id != previous:
+            _notify_change("roster", self, added=added, removed=removed,
+                           payer_id=self.payer_id, previous_payer_id=previous)
+        return added, removed
 
     def get_attendees(self):
         with get_connection() as conn:
@@ -243,73 +502,296 @@ class LunchEvent:
     def get_user_stats():
         """Returns dict of user_id -> {'paid': count, 'drank': count}"""
         with get_connection() as conn:
-            # Get drink counts (attendance)
-            drank_rows = conn.execute("""
-                SELECT user_id, COUNT(*) as drank_count
-                FROM lunch_attendance
-                GROUP BY user_id
+            rows = conn.execute("""
+                SELECT user_id, paid, drank
+                FROM user_lunch_stats
+                WHERE paid > 0 OR drank > 0
             """).fetchall()
-            
-            # Get paid counts
-            paid_rows = conn.execute("""
-                SELECT payer_id, COUNT(*) as paid_count
-                FROM lunch_events
-                WHERE payer_id IS NOT NULL
-                GROUP BY payer_id
+            return {r["user_id"]: {'paid': r["paid"], 'drank': r["drank"]} for r in rows}
+
+    @staticmethod
+    def _compute_user_stats(conn):
+        """Aggregates the stats from the raw history, bypassing user_lunch_stats."""
+        # Get drink counts (attendance)
+        drank_rows = conn.execute("""
+            SELECT user_id, COUNT(*) as drank_count
+            FROM lunch_attendance
+            GROUP BY user_id
+        """).fetchall()
+
+        # Get paid counts
+        paid_rows = conn.execute("""
+            SELECT payer_id, COUNT(*) as paid_count
+            FROM lunch_events
+            WHERE payer_id IS NOT NULL
+            GROUP BY payer_id
+        """).fetchall()
+
+        stats = {}
+        for row in drank_rows:
+            user_id = row["user_id"]
+            stats[user_id] = {'paid': 0, 'drank': row["drank_count"]}
+
+        for row in paid_rows:
+            user_id = row["payer_id"]
+            if user_id in stats:
+                stats[user_id]['paid'] = row["paid_count"]
+            else:
+                stats[user_id] = {'paid': row["paid_count"], 'drank': 0}
+
+        return stats
+
+    @staticmethod
+    def rebuild_user_stats():
+        """Recomputes user_lunch_stats from the raw history. Returns the number of rows written."""
+        with get_connection() as conn:
+            _begin_immediate(conn)  # no write may land between the aggregate and the rewrite
+            stats = LunchEvent._compute_user_stats(conn)
+            conn.execute("DELETE FROM user_lunch_stats")
+            conn.executemany(
+                "INSERT INTO user_lunch_stats (user_id, paid, drank) VALUES (?, ?, ?)",
+                [(user_id, s['paid'], s['drank']) for user_id, s in stats.items()]
+            )
+            bump_table_versions(conn, "user_lunch_stats")
+            return len(stats)
+
+    @staticmethod
+    def verify_user_stats():
+        """
+        Compares user_lunch_stats against the raw history.
+        Returns a dict of user_id -> (stored, expected) for every user that differs.
+        """
+        with get_connection() as conn:
+            expected = LunchEvent._compute_user_stats(conn)
+        stored = LunchEvent.get_user_stats()
+        empty = {'paid': 0, 'drank': 0}
+        mismatches = {}
+        for user_id in set(expected) | set(stored):
+            if stored.get(user_id, empty) != expected.get(user_id, empty):
+                mismatches[user_id] = (stored.get(user_id, empty), expected.get(user_id, empty))
+        return mismatches
+
+    @staticmethod
+    def rebuild_period_stats():
+        """Recomputes the Jalali month/year rollups in user_period_stats. Returns the number of rows written."""
+        with get_connection() as conn:
+            _begin_immediate(conn)
+            conn.execute("DELETE FROM user_period_stats")
+            bump_table_versions(conn, "user_period_stats")
+            return conn.execute("""
+                INSERT INTO user_period_stats (period, user_id, paid, drank)
+                SELECT period, user_id, SUM(paid), SUM(drank)
+                FROM (
+                    SELECT substr(le.event_date, 1, 7) AS period, la.user_id, 0 AS paid, 1 AS drank
+                    FROM lunch_attendance la JOIN lunch_events le ON le.id = la.lunch_event_id
+                    UNION ALL
+                    SELECT substr(le.event_date, 1, 4), la.user_id, 0, 1
+                    FROM lunch_attendance la JOIN lunch_events le ON le.id = la.lunch_event_id
+                    UNION ALL
+                    SELECT substr(event_date, 1, 7), payer_id, 1, 0 FROM lunch_events WHERE payer_id IS NOT NULL
+                    UNION ALL
+                    SELECT substr(event_date, 1, 4), payer_id, 1, 0 FROM lunch_events WHERE payer_id IS NOT NULL
+                )
+                GROUP BY period, user_id
+            """).rowcount
+
+    @staticmethod
+    def get_period_report(period):
+        """
+        Per-user totals for a Jalali year ('1403') or month ('1403-05'), read from
+        the rollups only. Returns a list of {user_id, display_name, paid, drank}.
+        """
+        with get_connection() as conn:
+            rows = conn.execute("""
+                SELECT s.user_id, u.display_name, s.paid, s.drank
+                FROM user_period_stats s
+                JOIN Users u ON u.id = s.user_id
+                WHERE s.period = ? AND (s.paid > 0 OR s.drank > 0)
+                ORDER BY u.display_name
+            """, [period]).fetchall()
+            return [dict(r) for r in rows]
+
+    @staticmethod
+    def list_periods():
+        """Years and months that have any rollup data, newest first."""
+        with get_connection() as conn:
+            rows = conn.execute("""
+                SELECT DISTINCT period FROM user_period_stats
+                WHERE paid > 0 OR drank > 0
+                ORDER BY period DESC
             """).fetchall()
-            
-            stats = {}
-            for row in drank_rows:
-                user_id = row["user_id"]
-                stats[user_id] = {'paid': 0, 'drank': row["drank_count"]}
-            
-            for row in paid_rows:
-                user_id = row["payer_id"]
-                if user_id in stats:
-                    stats[user_id]['paid'] = row["paid_count"]
-                else:
-                    stats[user_id] = {'paid': row["paid_count"], 'drank': 0}
-            
-            return stats
+            return [r["period"] for r in rows]
 
     @staticmethod
-    def get_next_payer(attendee_ids):
+    def get_next_payer(attendee_ids, stats=None, event_date=None):
         """
         Returns the user who should pay next based on paid-to-drank ratio.
-        Logic: lowest ratio pays next. If tie, random selection.
-        Only considers users in attendee_ids.
+        Logic: lowest ratio pays next. Ties are broken by a shuffle seeded with
+        the date, so reloading the page doesn't change the answer.
+        Only considers users in attendee_ids. See scheduler.py for the weighting options.
+        Pass stats if the caller already loaded them from get_user_stats().
         """
-        if not attendee_ids:
-            return None
-        
-        stats = LunchEvent.get_user_stats()
-        
-        # Calculate ratios for attendees
-        ratios = []
-        for user_id in attendee_ids:
-            if user_id in stats:
-                paid = stats[user_id]['paid']
-                drank = stats[user_id]['drank']
-            else:
-                paid = 0
-                drank = 0
-            
-            # Ratio: paid / drank (avoid division by zero)
-            if drank == 0:
-                ratio = 0  # Never drank, lowest priority (will be 0)
-            else:
-                ratio = paid / drank
-            
-            ratios.append((user_id, ratio))
-        
-        # Find minimum ratio
-        min_ratio = min(r[1] for r in ratios)
-        
-        # Get all users with minimum ratio
-        candidates = [r[0] for r in ratios if r[1] == min_ratio]
-        
-        # Random selection if tie
-        return random.choice(candidates)
+        from scheduler import default_scheduler
+        return default_scheduler.next_payer(attendee_ids, event_date, stats)
+
+    @staticmethod
+    def import_records(records, batch_size=1000):
+        """
+        Loads (line_no, record) pairs from history.read_records() in batches of
+        batch_size days per transaction. Days that already exist are merged: the
+        payer is replaced when the record names one and attendees are added.
+        Returns {"events": n, "attendance": n, "skipped": [(line_no, reason), ...]}.
+        """
+        user_ids = User.ids_by_name()
+        summary = {"events": 0, "attendance": 0, "skipped": []}
+        batch = []
+
+        for line_no, record in records:
+            try:
+                event_date = normalize_date(record["date"])
+            except ValueError:
+                summary["skipped"].append((line_no, f"invalid date {record['date']!r}"))
+                continue
+            unknown = [n for n in [record["payer"], *record["attendees"]] if n and n not in user_ids]
+            if unknown:
+                summary["skipped"].append((line_no, f"unknown users {sorted(set(unknown))}"))
+                continue
+            payer_id = user_ids[record["payer"]] if record["payer"] else None
+            batch.append((event_date, payer_id, [user_ids[n] for n in record["attendees"]]))
+            if len(batch) >= batch_size:
+                LunchEvent._import_batch(batch, summary)
+                batch = []
+        if batch:
+            LunchEvent._import_batch(batch, summary)
+        return summary
+
+    @staticmethod
+    def _import_batch(batch, summary):
+        def write(conn):
+            pairs = []
+            for event_date, payer_id, attendee_ids in batch:
+                event_id = conn.execute("""
+                    INSERT INTO lunch_events (event_date, payer_id) VALUES (?, ?)
+                    ON CONFLICT(event_date) DO UPDATE SET payer_id=COALESCE(excluded.payer_id, payer_id)
+                    RETURNING id
+                """, [event_date, payer_id]).fetchone()["id"]
+                pairs.extend((event_id, user_id) for user_id in attendee_ids)
+            cur = conn.executemany(
+                "INSERT OR IGNORE INTO lunch_attendance (lunch_event_id, user_id) VALUES (?, ?)", pairs
+            )
+            summary["events"] += len(batch)
+            summary["attendance"] += cur.rowcount
+        try:
+            with get_connection() as conn:
+                _begin_immediate(conn)
+                _acting(write)(conn)
+        except sqlite3.DatabaseError as e:
+            raise RuntimeError(f"Database error while importing history: {e}") from e
+
+    @staticmethod
+    def iter_history(chunk_size=500):
+        """
+        Iterator of (event_date, payer_name, [attendee names]) oldest first. Uses its
+        own connection and fetches chunk_size rows at a time, so it's safe to consume
+        from a streamed response after the request has finished. The shard is picked
+        now, while the request's team is still known, not when iteration starts.
+        """
+        return LunchEvent._iter_history(current_shard().path, chunk_size)
+
+    @staticmethod
+    def _iter_history(path, chunk_size):
+        conn = _connect(path)
+        try:
+            cur = conn.execute("""
+                SELECT le.event_date, p.name AS payer, GROUP_CONCAT(u.name, char(31)) AS attendees
+                FROM lunch_events le
+                LEFT JOIN Users p ON p.id = le.payer_id
+                LEFT JOIN lunch_attendance la ON la.lunch_event_id = le.id
+                LEFT JOIN Users u ON u.id = la.user_id
+                GROUP BY le.event_date
+                ORDER BY le.event_date
+            """)
+            while True:
+                rows = cur.fetchmany(chunk_size)
+                if not rows:
+                    break
+                for r in rows:
+                    yield r["event_date"], r["payer"], r["attendees"].split(chr(31)) if r["attendees"] else []
+        finally:
+            conn.close()
+
+    @staticmethod
+    def list_page(before=None, after=None, start=None, end=None, limit=20):
+        """
+        One page of history, newest first, using event_date as the keyset cursor:
+        pass the last date of a page as before= for the next (older) page, or the
+        first date as after= for the previous one. start/end bound the range (inclusive).
+        Each event gets .payer_name and .attendees, loaded with one query for the whole page.
+        Returns (events, has_more) where has_more says whether the page was cut at limit.
+        """
+        where, params = [], []
+        if before:
+            where.append("le.event_date < ?")
+            params.append(before)
+        if after:
+            where.append("le.event_date > ?")
+            params.append(after)
+        if start:
+            where.append("le.event_date >= ?")
+            params.append(start)
+        if end:
+            where.append("le.event_date <= ?")
+            params.append(end)
+        order = "ASC" if after and not before else "DESC"
+
+        with get_connection() as conn:
+            rows = conn.execute(f"""
+                SELECT le.*, u.display_name as payer_name
+                FROM lunch_events le
+                LEFT JOIN Users u ON le.payer_id = u.id
+                {"WHERE " + " AND ".join(where) if where else ""}
+                ORDER BY le.event_date {order}
+                LIMIT ?
+            """, [*params, limit + 1]).fetchall()
+            has_more = len(rows) > limit
+            rows = rows[:limit]
+            if order == "ASC":
+                rows.reverse()
+
+            events = {}
+            for r in rows:
+                e = LunchEvent(r["id"], r["event_date"], r["payer_id"])
+                e.payer_name = r["payer_name"]
+                e.attendees = []
+                events[e.id] = e
+
+            if events:
+                attendee_rows = conn.execute(f"""
+                    SELECT la.lunch_event_id, u.id, u.name, u.display_name, u.role, u.active
+                    FROM lunch_attendance la
+                    JOIN Users u ON u.id = la.user_id
+                    WHERE la.lunch_event_id IN ({",".join("?" * len(events))})
+                    ORDER BY u.display_name
+                """, list(events)).fetchall()
+                for r in attendee_rows:
+                    u = User(id=r["id"], name=r["name"], display_name=r["display_name"], role=r["role"])
+                    u._active = bool(r["active"])
+                    events[r["lunch_event_id"]].attendees.append(u)
+
+            return list(events.values()), has_more
+
+    @staticmethod
+    def summary():
+        """Totals for the current shard: active users, lunches, paid lunches, drinks and the date range."""
+        with get_connection() as conn:
+            return dict(conn.execute("""
+                SELECT (SELECT COUNT(*) FROM Users WHERE active=1) AS users,
+                       (SELECT COUNT(*) FROM lunch_events) AS lunches,
+                       (SELECT COUNT(*) FROM lunch_events WHERE payer_id IS NOT NULL) AS paid,
+                       (SELECT COUNT(*) FROM lunch_attendance) AS drinks,
+                       (SELECT MIN(event_date) FROM lunch_events) AS first_date,
+                       (SELECT MAX(event_date) FROM lunch_events) AS last_date
+            """).fetchone())
 
     @staticmethod
     def list_recent(limit=10):
@@ -330,24 +812,532 @@ class LunchEvent:
             return events
 
 
-def get_connection():
-    connection = sqlite3.connect(DB_PATH)
+class LunchDashboard:
+    """
+    Read model for the lunch page. Loads everything lunch.html needs for a date
+    in two queries and keeps count of them in query_count. With recent_limit=0
+    the recent history query is skipped. query_count leaves out get_next_payer():
+    with all-time totals it reuses the loaded stats, but a windowed or decayed
+    scheduler (scheduler.py) runs two queries of its own.
+    """
+    def __init__(self, event_date, recent_limit=10):
+        self.event_date = event_date
+        self.recent_limit = recent_limit
+        self.query_count = 0
+
+        self.event = None
+        self.all_users = []
+        self.attendees = []
+        self.stats = {}
+        self.recent_events = []
+        self.next_payer = None
+        self.next_payer_user = None
+
+        self._load()
+
+    def _execute(self, conn, sql, params=()):
+        self.query_count += 1
+        return conn.execute(sql, params).fetchall()
+
+    def _load(self):
+        with get_connection() as conn:
+            rows = self._execute(conn, """
+                WITH today AS (
+                    SELECT id, payer_id FROM lunch_events WHERE event_date = ?
+                )
+                SELECT u.id, u.name, u.display_name, u.role, u.active,
+                       t.id AS event_id, t.payer_id,
+                       la.user_id IS NOT NULL AS attending,
+                       COALESCE(s.paid, 0) AS paid, COALESCE(s.drank, 0) AS drank
+                FROM Users u
+                LEFT JOIN today t
+                LEFT JOIN lunch_attendance la ON la.lunch_event_id = t.id AND la.user_id = u.id
+                LEFT JOIN user_lunch_stats s ON s.user_id = u.id
+                ORDER BY u.id
+            """, [self.event_date])
+            recent_rows = []
+            if self.recent_limit:
+                recent_rows = self._execute(conn, """
+                    SELECT le.*, u.display_name as payer_name
+                    FROM lunch_events le
+                    LEFT JOIN Users u ON le.payer_id = u.id
+                    ORDER BY le.event_date DESC
+                    LIMIT ?
+                """, [self.recent_limit])
+
+        users_by_id = {}
+        for r in rows:
+            e = User(id=r["id"], name=r["name"], display_name=r["display_name"], role=r["role"])
+            e._active = bool(r["active"])
+            users_by_id[e.id] = e
+            self.all_users.append(e)
+            if r["attending"]:
+                self.attendees.append(e)
+            if r["paid"] or r["drank"]:
+                self.stats[e.id] = {'paid': r["paid"], 'drank': r["drank"]}
+            if self.event is None and r["event_id"] is not None:
+                self.event = LunchEvent(r["event_id"], self.event_date, r["payer_id"])
+
+        if self.event is not None:
+            payer = users_by_id.get(self.event.payer_id)
+            self.event.payer_name = payer.display_name if payer else None
+
+        for r in recent_rows:
+            e = LunchEvent(r["id"], r["event_date"], r["payer_id"])
+            e.payer_name = r["payer_name"]
+            self.recent_events.append(e)
+
+        if self.attendees:
+            self.next_payer = LunchEvent.get_next_payer(self.attendee_ids, self.stats, self.event_date)
+            self.next_payer_user = users_by_id.get(self.next_payer)
+
+    @property
+    def attendee_ids(self):
+        return [a.id for a in self.attendees]
+
+    def template_context(self):
+        return dict(today=self.event_date,
+                    event=self.event,
+                    attendees=self.attendees,
+                    attendee_ids=self.attendee_ids,
+                    all_users=self.all_users,
+                    next_payer=self.next_payer,
+                    next_payer_user=self.next_payer_user,
+                    stats=self.stats,
+                    recent_events=self.recent_events)
+
+
+_local = threading.local()
+# Callables run on every new connection, e.g. to install a trace callback.
+connection_hooks = []
+# Callables run as listener(kind, lunch_event, details) after a LunchEvent write commits.
+change_listeners = []
+
+def _notify_change(kind, event, **details):
+    for listener in change_listeners:
+        listener(kind, event, details)
+
+class DuplicateAction(ValueError):
+    """Raised by a write whose action_key() was already recorded."""
+
+
+@contextmanager
+def action_key(key):
+    """
+    The next run_write() in the block records key in action_keys in the same
+    transaction, or raises DuplicateAction without writing if it's there already.
+    """
+    _local.action_key = key
+    try:
+        yield
+    finally:
+        _local.action_key = None
+
+def _claiming(key, fn):
+    def write(conn, *args):
+        claimed = conn.execute(
+            "INSERT INTO action_keys (user_id, key) VALUES (?, ?) ON CONFLICT (user_id, key) DO NOTHING",
+            [current_actor() or 0, key]
+        ).rowcount
+        if not claimed:
+            raise DuplicateAction(f"Action {key} was already applied")
+        return fn(conn, *args)
+    return write
+
+def prune_action_keys(days):
+    """Forgets idempotency keys older than days. Returns how many were removed."""
+    return run_write(lambda conn: conn.execute(
+        "DELETE FROM action_keys WHERE created_at < datetime('now', ?)", [f"-{days} days"]
+    ).rowcount)
+
+def set_actor(user_id):
+    """Records user_id as the one making this thread's changes in lunch_ledger, until the request ends."""
+    _local.actor = user_id
+
+def current_actor():
+    return getattr(_local, "actor", None)
+
+def _acting(fn):
+    """
+    Wraps fn(conn, *args) so the lunch_ledger triggers (migrations/0011) record
+    current_actor() for its changes: ledger_context holds the actor only inside
+    the write's own transaction, any other writer sees NULL.
+    """
+    def write(conn, *args):
+        actor = current_actor()
+        if actor is None:
+            return fn(conn, *args)
+        conn.execute("UPDATE ledger_context SET actor_id=? WHERE id=1", [actor])
+        try:
+            return fn(conn, *args)
+        finally:
+            try:
+                conn.execute("UPDATE ledger_context SET actor_id=NULL WHERE id=1")
+            except sqlite3.Error:
+                pass  # the transaction is being rolled back anyway
+    return write
+
+def _connect(path):
+    connection = sqlite3.connect(path, timeout=DB_BUSY_TIMEOUT_MS / 1000, check_same_thread=False)
     connection.row_factory = sqlite3.Row
+    connection.execute("PRAGMA journal_mode=WAL;")
+    connection.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS};")
+    connection.execute("PRAGMA synchronous=NORMAL;")
+    connection.execute(f"PRAGMA mmap_size={DB_MMAP_SIZE};")
     connection.execute("PRAGMA foreign_keys=ON;")
+    for hook in connection_hooks:
+        hook(connection)
     return connection
 
-def make_db():
-    DB_PATH.parent.mkdir(parents=True, exist_ok=True)
-    with get_connection() as conn, open("schema.sql") as sch:
-        conn.executescript(sch.read())
-        
+def get_connection():
+    """
+    Returns the current shard's connection bound to this thread, taking one
+    from the shard's pool (or opening a new one) on first use. It stays bound
+    until release_connection() is called, which Flask does at the end of each request.
+    """
+    shard = current_shard()
+    connections = _local.__dict__.setdefault("connections", {})
+    connection = connections.get(shard)
+    if connection is None:
+        try:
+            connection = shard.pool.get_nowait()
+        except queue.Empty:
+            connection = _connect(shard.path)
+        connections[shard] = connection
+    return connection
+
+def release_connection(exc=None):
+    """Commits (or rolls back on error) and hands the thread's connections back to their pools."""
+    connections = _local.__dict__.get("connections")
+    if not connections:
+        return
+    _local.connections = {}
+    for shard, connection in connections.items():
+        try:
+            if exc is None:
+                connection.commit()
+            else:
+                connection.rollback()
+        except sqlite3.Error:
+            connection.close()
+            continue
+        try:
+            shard.pool.put_nowait(connection)
+        except queue.Full:
+            connection.close()
+
+def _begin_immediate(conn):
+    """Takes the write lock up front so a read-then-write can't be raced."""
+    if not conn.in_transaction:
+        conn.execute("BEGIN IMMEDIATE")
+
+class WriteQueue:
+    """
+    Serializes writes through one writer thread with its own connection.
+    Callers submit fn(conn) and get a Future; the writer takes whatever is
+    queued (up to batch_size), runs each under a savepoint so one failing
+    write doesn't undo the others, and commits the batch once. Reads stay on
+    the callers' own connections and run in parallel with it under WAL.
+    """
+    def __init__(self, path, batch_size=WRITE_BATCH_SIZE):
+        self.path = path
+        self.batch_size = batch_size
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, fn, *args):
+        future = Future()
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="db-writer", daemon=True)
+                self._thread.start()
+            self._queue.put((fn, args, current_actor(), future))
+        return future
+
+    def _run(self):
+        connection = _connect(self.path)
+        try:
+            while True:
+                batch = [self._queue.get()]
+                while batch[-1] is not None and len(batch) < self.batch_size:
+                    try:
+                        batch.append(self._queue.get_nowait())
+                    except queue.Empty:
+                        break
+                stop = batch[-1] is None
+                if stop:
+                    batch.pop()
+                if batch:
+                    self._commit_batch(connection, batch)
+                if stop:
+                    return
+        finally:
+            connection.close()
+
+    def _commit_batch(self, connection, batch):
+        outcomes = []
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+            for fn, args, actor, future in batch:
+                if not future.set_running_or_notify_cancel():
+                    continue
+                _local.actor = actor
+                connection.execute("SAVEPOINT write")
+                try:
+                    outcomes.append((future, fn(connection, *args), None))
+                except Exception as e:
+                    connection.execute("ROLLBACK TO write")
+                    outcomes.append((future, None, e))
+                connection.execute("RELEASE write")
+            connection.commit()
+        except sqlite3.Error as e:
+            connection.rollback()
+            for fn, args, actor, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        # Only after the commit, so callers can read their own writes
+        for future, result, error in outcomes:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+    def shutdown(self):
+        """Finishes the queued writes and stops the thread. A later submit() starts a new one."""
+        with self._lock:
+            thread, self._thread = self._thread, None
+            if thread is not None:
+                self._queue.put(None)
+        if thread is not None:
+            thread.join()
+
+
+class Shard:
+    """One team's database file, with its own connection pool, identity cache and writer."""
+    def __init__(self, name, path):
+        self.name = name
+        self.path = Path(path)
+        self.pool = queue.LifoQueue(maxsize=DB_POOL_SIZE)
+        self.identity_cache = IdentityCache()
+        self.write_queue = WriteQueue(self.path)
+
+    def close(self):
+        self.write_queue.shutdown()
+        while True:
+            try:
+                self.pool.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+default_shard = Shard(DEFAULT_TEAM, DB_PATH)
+_shards = {}
+_shards_lock = threading.Lock()
+
+def current_shard():
+    """The shard this thread works on: the request's team, or the default one."""
+    return getattr(_local, "shard", None) or default_shard
+
+@contextmanager
+def _bound(shard):
+    previous, _local.shard = getattr(_local, "shard", None), shard
+    try:
+        yield shard
+    finally:
+        _local.shard = previous
+
+def use_shard(team):
+    """Context manager running the block's User/LunchEvent calls against team's database."""
+    return _bound(get_shard(team))
+
+def team_path(team):
+    return TEAMS_DIR / f"{team}.sqlite"
+
+def get_shard(team):
+    """The shard for team, opened and migrated on first use. Raises LookupError for unknown teams."""
+    if team == DEFAULT_TEAM:
+        return default_shard
+    shard = _shards.get(team)
+    if shard is None:
+        if TEAMS_DIR is None or not TEAM_NAME_RE.match(team) or not team_path(team).exists():
+            raise LookupError(f"No team named {team!r}")
+        with _shards_lock:
+            shard = _shards.get(team)
+            if shard is None:
+                shard = Shard(team, team_path(team))
+                make_db(shard)
+                _shards[team] = shard
+    return shard
+
+def create_team(team):
+    """Creates and migrates team's database. Raises ValueError if it can't."""
+    if TEAMS_DIR is None:
+        raise ValueError("Set TEAMS_DIR to use more than one team")
+    if not TEAM_NAME_RE.match(team) or team == DEFAULT_TEAM:
+        raise ValueError("Team names are lowercase letters, digits and dashes")
+    if team_path(team).exists():
+        raise ValueError(f"Team {team!r} already exists")
+    TEAMS_DIR.mkdir(parents=True, exist_ok=True)
+    make_db(Shard(team, team_path(team)))
+    return get_shard(team)
+
+def list_teams():
+    teams = [DEFAULT_TEAM]
+    if TEAMS_DIR is not None and TEAMS_DIR.is_dir():
+        teams += sorted(p.stem for p in TEAMS_DIR.glob("*.sqlite") if TEAM_NAME_RE.match(p.stem))
+    return teams
+
+def team_for_host(host):
+    """acme.<TEAM_DOMAIN> -> "acme", anything else -> the default team."""
+    host = host.split(":")[0].lower()
+    if TEAM_DOMAIN and host.endswith("." + TEAM_DOMAIN):
+        return host[:-len(TEAM_DOMAIN) - 1]
+    return DEFAULT_TEAM
+
+def run_write(fn, *args):
+    """
+    Runs fn(conn, *args) as one write transaction and returns its result: through
+    the shard's write queue with DB_WRITE_QUEUE=1, otherwise on this thread's connection.
+    Inside action_key(), the key is claimed in the same transaction.
+    """
+    fn = _acting(fn)
+    key = getattr(_local, "action_key", None)
+    if key is not None:
+        _local.action_key = None
+        fn = _claiming(key, fn)
+    if DB_WRITE_QUEUE:
+        return current_shard().write_queue.submit(fn, *args).result()
+    with get_connection() as conn:
+        _begin_immediate(conn)
+        return fn(conn, *args)
+
+def warm_pool(size):
+    """Opens connections until the current shard's pool holds size of them (at most DB_POOL_SIZE)."""
+    shard = current_shard()
+    while shard.pool.qsize() < min(size, DB_POOL_SIZE):
+        try:
+            shard.pool.put_nowait(_connect(shard.path))
+        except queue.Full:
+            break
+
+def close_all_connections():
+    release_connection()
+    for shard in [default_shard, *_shards.values()]:
+        shard.close()
+
+def init_app(app):
+    """Picks the request's shard from its host name (404 for unknown teams) and releases connections after it."""
+    from flask import request, abort
+
+    @app.before_request
+    def _select_shard():
+        try:
+            _local.shard = get_shard(team_for_host(request.host))
+        except LookupError:
+            abort(404)
+
+    @app.teardown_appcontext
+    def _release(exc):
+        release_connection(exc)
+        _local.shard = None
+        _local.actor = None
+
+def _migration_scripts():
+    """schema.sql is version 1, migrations/NNNN_name.sql is version NNNN."""
+    scripts = [(1, SCHEMA_PATH)]
+    for path in sorted(MIGRATIONS_DIR.glob("*.sql")):
+        scripts.append((int(path.name.split("_", 1)[0]), path))
+    return scripts
+
+def _split_statements(script):
+    statements, buf = [], ""
+    for line in script.splitlines(keepends=True):
+        buf += line
+        if sqlite3.complete_statement(buf):
+            statements.append(buf)
+            buf = ""
+    if buf.strip():
+        statements.append(buf)
+    return statements
+
+def get_data_version():
+    """The counter the data_version triggers bump on every write to users, events and attendance."""
+    with get_connection() as conn:
+        return conn.execute("SELECT version FROM data_version WHERE id=1").fetchone()["version"]
+
+def get_table_versions():
+    """Write counters per table, e.g. {"Users": 3, "lunch_events": 10, "lunch_attendance": 42}."""
+    with get_connection() as conn:
+        return {r["name"]: r["version"] for r in conn.execute("SELECT name, version FROM table_versions")}
+
+def bump_table_versions(conn, *names):
+    """For writes the version triggers don't see: bumps data_version and the named table_versions rows."""
+    conn.execute("UPDATE data_version SET version = version + 1 WHERE id = 1")
+    conn.executemany("UPDATE table_versions SET version = version + 1 WHERE name = ?", [(n,) for n in names])
+
+def get_schema_version():
+    with get_connection() as conn:
+        return conn.execute("PRAGMA user_version").fetchone()[0]
+
+def make_db(shard=None):
+    """
+    Brings the database (of shard, default the current one) up to date,
+    applying every script newer than its PRAGMA user_version. Each script runs
+    in its own write transaction together with the version bump, so concurrent
+    starters apply it exactly once. Returns the resulting version.
+    """
+    shard = shard or current_shard()
+    shard.path.parent.mkdir(parents=True, exist_ok=True)
+    with _bound(shard), _migration_lock(shard.path):
+        return _migrate()
+
+@contextmanager
+def _migration_lock(path):
+    """
+    Held while migrating, so when several workers start together one applies
+    the scripts and the others wait and find the schema already current,
+    instead of queueing on SQLite's write lock until busy_timeout.
+    """
+    if fcntl is None:
+        yield
+        return
+    with open(f"{path}.migrate.lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+def _migrate():
+    conn = get_connection()
+    version = get_schema_version()
+    for target, path in _migration_scripts():
+        if target <= version:
+            continue
+        statements = _split_statements(path.read_text(encoding="utf8"))
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            if target > version:
+                for statement in statements:
+                    conn.execute(statement)
+                conn.execute(f"PRAGMA user_version={target}")
+                version = target
+            conn.commit()
+        except sqlite3.Error as e:
+            conn.rollback()
+            raise RuntimeError(f"Migration {path.name} failed: {e}") from e
+    release_connection()
+    return version
 
-if not DB_PATH.exists():
-    make_db()
 
 if __name__ == "__main__":
-    if Path.exists(DB_PATH):
-        os.remove(DB_PATH)
+    close_all_connections()
+    for path in (DB_PATH, Path(f"{DB_PATH}-wal"), Path(f"{DB_PATH}-shm"), Path(f"{DB_PATH}.migrate.lock")):
+        if Path.exists(path):
+            os.remove(path)
     make_db()
     r = User(name="amiroof", display_name="فیروزفر", role="technician", password="username")
     r.save()
@@ -0,0 +1,58 @@
+"""
+Cache of rendered HTML fragments.
+
+Each fragment is keyed by the team and the write counters
+(db.get_table_versions()) of the tables it's built from, so a write only invalidates the fragments that read
+that table: toggling attendance re-renders the stats table but not the
+history. Old versions are never served again and fall out of the LRU.
+"""
+import os, threading
+from collections import OrderedDict
+from markupsafe import Markup
+from db import current_shard
+
+FRAGMENT_CACHE_SIZE = int(os.getenv("FRAGMENT_CACHE_SIZE", "64"))
+
+# Tables each fragment's contents depend on
+FRAGMENT_TABLES = {
+    "user_stats": ("Users", "lunch_events", "lunch_attendance", "user_lunch_stats"),
+    "recent_history": ("Users", "lunch_events"),
+}
+
+
+class FragmentCache:
+    def __init__(self, maxsize=FRAGMENT_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def key(self, name, versions):
+        return (current_shard().name, name) + tuple(versions[t] for t in FRAGMENT_TABLES[name])
+
+    def get(self, key):
+        with self._lock:
+            html = self._entries.get(key)
+            if html is not None:
+                self._entries.move_to_end(key)
+            return html
+
+    def put(self, key, html):
+        with self._lock:
+            self._entries[key] = html
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def get_or_render(self, key, render):
+        html = self.get(key)
+        if html is None:
+            html = Markup(render())
+            self.put(key, html)
+        return html
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+fragment_cache = FragmentCache()
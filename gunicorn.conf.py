@@ -0,0 +1,41 @@
+"""
+Production server settings.
+
+    pip install gunicorn
+    gunicorn -c gunicorn.conf.py app:app
+
+Prefork: one worker process per core (WEB_WORKERS), each serving WEB_THREADS
+requests at a time. `kill -HUP <master pid>` reloads gracefully: new workers
+load the new code and warm up, then the old ones finish their requests and exit.
+
+Caches and the hashing pool are per worker. Live updates work across workers:
+each one polls data_version (see live.py). Every open /lunch/stream holds one of
+its worker's threads, so a worker serves at most half its threads as streams
+(LIVE_MAX_STREAMS); pages past that fall back to polling the dashboard.
+
+Behind a reverse proxy, set TRUSTED_PROXIES (see app.py) to the number of proxies
+so login throttling and team routing use the client's address and host.
+"""
+import os
+
+bind = os.getenv("BIND", "0.0.0.0:2000")
+workers = int(os.getenv("WEB_WORKERS", str(os.cpu_count() or 1)))
+# Threads, so open /lunch/stream connections don't each hold a whole process
+worker_class = "gthread"
+threads = int(os.getenv("WEB_THREADS", "32"))
+# Read by live.py when the workers import the app
+os.environ.setdefault("LIVE_MAX_STREAMS", str(max(1, threads // 2)))
+timeout = 60
+graceful_timeout = 30
+keepalive = 5
+# Workers import the app themselves, so a HUP picks up new code
+preload_app = False
+
+
+def post_worker_init(worker):
+    # Runs before the worker accepts connections. Migrations happen here too,
+    # not in the master, so it never imports app code a HUP would have to
+    # replace; the first worker applies them and the rest wait on the lock.
+    from app import startup
+    startup(connections=threads)
+    worker.log.info("Worker %s warmed up", worker.pid)
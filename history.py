@@ -0,0 +1,75 @@
+"""
+Streaming CSV/JSONL readers and writers for lunch history.
+
+One record per lunch day:
+    CSV:   date,payer,attendees        (attendees separated by ";")
+    JSONL: {"date": "1402-01-15", "payer": "ali", "attendees": ["ali", "sara"]}
+Users are referenced by their login name and dates are Jalali YYYY-MM-DD.
+"""
+import csv, io, json
+
+FORMATS = ("csv", "jsonl")
+MIMETYPES = {"csv": "text/csv", "jsonl": "application/x-ndjson"}
+CSV_HEADER = ["date", "payer", "attendees"]
+
+
+def guess_format(filename, default="csv"):
+    if filename and filename.lower().endswith((".jsonl", ".ndjson")):
+        return "jsonl"
+    if filename and filename.lower().endswith(".csv"):
+        return "csv"
+    return default
+
+def read_records(stream, fmt):
+    """Yields (line_no, {"date", "payer", "attendees"}) from a text stream, one line at a time."""
+    if fmt == "csv":
+        reader = csv.DictReader(stream)
+        for record in reader:
+            attendees = record.get("attendees") or ""
+            yield reader.line_num, {
+                "date": (record.get("date") or "").strip(),
+                "payer": (record.get("payer") or "").strip() or None,
+                "attendees": [a.strip() for a in attendees.split(";") if a.strip()],
+            }
+    elif fmt == "jsonl":
+        for line_no, line in enumerate(stream, 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError as e:
+                raise ValueError(f"Line {line_no}: invalid JSON: {e}") from e
+            if not isinstance(record, dict):
+                raise ValueError(f"Line {line_no}: expected a JSON object")
+            payer = record.get("payer") or None
+            attendees = record.get("attendees") or []
+            if payer is not None and not isinstance(payer, str):
+                raise ValueError(f"Line {line_no}: payer must be a login name")
+            if not isinstance(attendees, list) or not all(isinstance(a, str) for a in attendees):
+                raise ValueError(f"Line {line_no}: attendees must be a list of login names")
+            yield line_no, {
+                "date": str(record.get("date") or "").strip(),
+                "payer": payer,
+                "attendees": attendees,
+            }
+    else:
+        raise ValueError(f"Unknown format {fmt!r}, expected one of {FORMATS}")
+
+def write_records(records, fmt):
+    """Turns (date, payer, [attendees]) tuples into chunks of text, one record per line."""
+    if fmt == "csv":
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+        writer.writerow(CSV_HEADER)
+        for date, payer, attendees in records:
+            writer.writerow([date, payer or "", ";".join(attendees)])
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+        if buf.getvalue():  # header only, there were no records
+            yield buf.getvalue()
+    elif fmt == "jsonl":
+        for date, payer, attendees in records:
+            yield json.dumps({"date": date, "payer": payer, "attendees": attendees}, ensure_ascii=False) + "\n"
+    else:
+        raise ValueError(f"Unknown format {fmt!r}, expected one of {FORMATS}")
@@ -0,0 +1,142 @@
+"""
+Append-only ledger of attendance and payer changes.
+
+Triggers (migrations/0008_lunch_ledger.sql) append an entry for every change,
+with the user who made it. Every LEDGER_SNAPSHOT_EVERY entries the per-user
+paid/drank totals are stored as a snapshot, so the current totals are the
+latest snapshot plus the entries after it. Replaying the whole ledger from the
+first entry rebuilds them without any snapshot, to check user_lunch_stats or
+rewrite it from the ledger.
+"""
+import os
+from contextlib import contextmanager
+from db import get_connection, run_write, change_listeners, bump_table_versions
+
+# 0 turns automatic snapshots off (`flask --app app ledger-snapshot` still works)
+LEDGER_SNAPSHOT_EVERY = int(os.getenv("LEDGER_SNAPSHOT_EVERY", "500"))
+
+
+@contextmanager
+def _read_transaction(conn):
+    """Snapshot and tail (or ledger and stats) are read as of the same moment."""
+    if conn.in_transaction:
+        yield
+        return
+    conn.execute("BEGIN")
+    try:
+        yield
+    finally:
+        conn.commit()
+
+def _apply(totals, entry):
+    empty = {'paid': 0, 'drank': 0}
+    if entry["kind"] == "payer":
+        if entry["previous_user_id"] is not None:
+            totals.setdefault(entry["previous_user_id"], dict(empty))['paid'] -= 1
+        if entry["user_id"] is not None:
+            totals.setdefault(entry["user_id"], dict(empty))['paid'] += 1
+    else:
+        totals.setdefault(entry["user_id"], dict(empty))['drank'] += 1 if entry["kind"] == "attend" else -1
+
+def _state(conn, full=False):
+    seq, totals = 0, {}
+    if not full:
+        latest = conn.execute("SELECT MAX(seq) AS seq FROM ledger_snapshots").fetchone()["seq"]
+        if latest is not None:
+            seq = latest
+            totals = {r["user_id"]: {'paid': r["paid"], 'drank': r["drank"]} for r in conn.execute(
+                "SELECT user_id, paid, drank FROM ledger_snapshot_totals WHERE seq=?", [seq]
+            )}
+    for entry in conn.execute(
+        "SELECT seq, kind, user_id, previous_user_id FROM lunch_ledger WHERE seq > ? ORDER BY seq", [seq]
+    ):
+        _apply(totals, entry)
+        seq = entry["seq"]
+    return seq, {u: t for u, t in totals.items() if t['paid'] or t['drank']}
+
+def state(full=False):
+    """
+    (seq, totals): user_id -> {'paid', 'drank'} as of ledger entry seq, from the
+    latest snapshot and the entries after it, or from every entry with full=True.
+    """
+    with get_connection() as conn:
+        with _read_transaction(conn):
+            return _state(conn, full)
+
+def snapshot():
+    """Stores the current totals. Returns the seq they're as of, or None if nothing changed since the last snapshot."""
+    def take(conn):
+        latest = conn.execute("SELECT MAX(seq) AS seq FROM ledger_snapshots").fetchone()["seq"]
+        seq, totals = _state(conn)
+        if seq == (latest or 0):
+            return None
+        conn.execute("INSERT INTO ledger_snapshots (seq) VALUES (?)", [seq])
+        conn.executemany(
+            "INSERT INTO ledger_snapshot_totals (seq, user_id, paid, drank) VALUES (?, ?, ?, ?)",
+            [(seq, user_id, t['paid'], t['drank']) for user_id, t in totals.items()]
+        )
+        return seq
+    return run_write(take)
+
+def maybe_snapshot(kind, event, details):
+    """db.change_listeners hook: snapshots once LEDGER_SNAPSHOT_EVERY entries piled up since the last one."""
+    if not LEDGER_SNAPSHOT_EVERY:
+        return
+    with get_connection() as conn:
+        row = conn.execute("""
+            SELECT (SELECT MAX(seq) FROM lunch_ledger) AS head,
+                   (SELECT MAX(seq) FROM ledger_snapshots) AS snapshot
+        """).fetchone()
+    if (row["head"] or 0) - (row["snapshot"] or 0) >= LEDGER_SNAPSHOT_EVERY:
+        snapshot()
+
+def verify(full=False):
+    """
+    Compares user_lunch_stats with the ledger's totals (replaying every entry with full=True).
+    Returns a dict of user_id -> (stored, replayed) for every user that differs.
+    """
+    with get_connection() as conn:
+        with _read_transaction(conn):
+            replayed = _state(conn, full)[1]
+            stored = {r["user_id"]: {'paid': r["paid"], 'drank': r["drank"]} for r in conn.execute(
+                "SELECT user_id, paid, drank FROM user_lunch_stats WHERE paid != 0 OR drank != 0"
+            )}
+    empty = {'paid': 0, 'drank': 0}
+    return {user_id: (stored.get(user_id, empty), replayed.get(user_id, empty))
+            for user_id in set(stored) | set(replayed)
+            if stored.get(user_id, empty) != replayed.get(user_id, empty)}
+
+def rebuild_stats(full=False):
+    """
+    Rewrites user_lunch_stats with the ledger's totals (replaying every entry
+    with full=True). Returns the number of rows written.
+    """
+    def rebuild(conn):
+        totals = _state(conn, full)[1]
+        conn.execute("DELETE FROM user_lunch_stats")
+        conn.executemany(
+            "INSERT INTO user_lunch_stats (user_id, paid, drank) VALUES (?, ?, ?)",
+            [(user_id, t['paid'], t['drank']) for user_id, t in totals.items()]
+        )
+        bump_table_versions(conn, "user_lunch_stats")
+        return len(totals)
+    return run_write(rebuild)
+
+def entries(before=None, limit=50):
+    """Newest entries first, with user names, using seq as the keyset cursor. Returns (entries, has_more)."""
+    with get_connection() as conn:
+        rows = conn.execute(f"""
+            SELECT l.*, a.display_name AS actor_name, u.display_name AS user_name,
+                   p.display_name AS previous_user_name
+            FROM lunch_ledger l
+            LEFT JOIN Users a ON a.id = l.actor_id
+            LEFT JOIN Users u ON u.id = l.user_id
+            LEFT JOIN Users p ON p.id = l.previous_user_id
+            {"WHERE l.seq < ?" if before else ""}
+            ORDER BY l.seq DESC
+            LIMIT ?
+        """, [*([before] if before else []), limit + 1]).fetchall()
+    return [dict(r) for r in rows[:limit]], len(rows) > limit
+
+
+change_listeners.append(maybe_snapshot)
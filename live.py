@@ -0,0 +1,151 @@
+"""
+Server-Sent Events for the lunch page.
+
+One poller thread per process watches data_version of every team that has
+pages connected, so writes made by any worker (or the CLI) are seen. When it
+moves, today's dashboard is built once and fanned out to the team's pages
+through per-client queues; writes in this process wake the poller right away.
+Subscribers never touch the database.
+
+Every open stream holds a server thread, so at most LIVE_MAX_STREAMS are
+served per process; past that /lunch/stream answers 503 and the page polls
+/api/lunch/dashboard instead.
+"""
+import json, os, queue, sqlite3, threading
+import jdatetime
+from db import LunchDashboard, change_listeners, current_shard, get_data_version, release_connection, use_shard
+
+# Events a slow client may fall behind by before it's dropped (it reconnects and reloads)
+SUBSCRIBER_BACKLOG = 100
+HEARTBEAT_SECONDS = 15
+LIVE_MAX_STREAMS = int(os.getenv("LIVE_MAX_STREAMS", "32"))
+LIVE_POLL_SECONDS = float(os.getenv("LIVE_POLL_SECONDS", "1"))
+
+
+class StreamsFull(RuntimeError):
+    """Raised when this process already serves LIVE_MAX_STREAMS streams."""
+
+
+def dashboard_data(dashboard, user_ids=None):
+    """
+    What the lunch page applies to itself, from an SSE message or
+    /api/lunch/dashboard: the roster, payers and the stats of user_ids (default everyone).
+    """
+    empty = {'paid': 0, 'drank': 0}
+    next_payer = dashboard.next_payer_user
+    if user_ids is None:
+        user_ids = [u.id for u in dashboard.all_users]
+    return {
+        "date": dashboard.event_date,
+        "attendee_ids": dashboard.attendee_ids,
+        "payer_id": dashboard.event.payer_id if dashboard.event else None,
+        "payer_name": dashboard.event.payer_name if dashboard.event else None,
+        "next_payer": {"id": next_payer.id, "display_name": next_payer.display_name} if next_payer else None,
+        "stats": {user_id: dashboard.stats.get(user_id, empty) for user_id in user_ids},
+    }
+
+
+class Broadcaster:
+    def __init__(self, backlog=SUBSCRIBER_BACKLOG, max_streams=LIVE_MAX_STREAMS, poll_seconds=LIVE_POLL_SECONDS):
+        self.backlog = backlog
+        self.max_streams = max_streams
+        self.poll_seconds = poll_seconds
+        self._subscribers = {}  # team -> set of queues
+        self._versions = {}     # team -> data_version last published
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._poller = None
+
+    @property
+    def subscriber_count(self):
+        return sum(len(queues) for queues in self._subscribers.values())
+
+    def subscribe(self, team):
+        """A queue of the team's messages. Raises StreamsFull at max_streams subscribers."""
+        q = queue.Queue(maxsize=self.backlog)
+        q.team = team
+        with self._lock:
+            if self.subscriber_count >= self.max_streams:
+                raise StreamsFull("Too many live pages open, try again later")
+            self._subscribers.setdefault(team, set()).add(q)
+            if self._poller is None:
+                self._poller = threading.Thread(target=self._poll, name="live-poller", daemon=True)
+                self._poller.start()
+        return q
+
+    def unsubscribe(self, q):
+        with self._lock:
+            queues = self._subscribers.get(q.team)
+            if queues is not None:
+                queues.discard(q)
+                if not queues:
+                    del self._subscribers[q.team]
+
+    def publish(self, team, event_type, data):
+        message = f"event: {event_type}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+        with self._lock:
+            subscribers = list(self._subscribers.get(team, ()))
+        for q in subscribers:
+            try:
+                q.put_nowait(message)
+            except queue.Full:
+                # Too far behind: end its stream, the client reconnects and reloads
+                self.unsubscribe(q)
+                with q.mutex:
+                    q.queue.clear()
+                q.put_nowait(None)
+
+    def stream(self, q):
+        """Generator of SSE text for one subscriber, with heartbeats to keep proxies from timing out."""
+        try:
+            yield "retry: 3000\n\n"
+            while True:
+                try:
+                    message = q.get(timeout=HEARTBEAT_SECONDS)
+                except queue.Empty:
+                    yield ": heartbeat\n\n"
+                    continue
+                if message is None:
+                    return
+                yield message
+        finally:
+            self.unsubscribe(q)
+
+    def check(self, team):
+        """Publishes today's dashboard to team's pages if its data_version moved since the last call."""
+        with use_shard(team):
+            try:
+                version = get_data_version()
+                if self._versions.get(team) in (None, version):
+                    self._versions[team] = version  # first look, the pages just loaded it
+                    return
+                today = jdatetime.date.today().strftime("%Y-%m-%d")
+                data = dashboard_data(LunchDashboard(today, recent_limit=0))
+            finally:
+                release_connection()
+        self._versions[team] = version
+        self.publish(team, "dashboard", data)
+
+    def _poll(self):
+        while True:
+            self._wake.wait(self.poll_seconds)
+            self._wake.clear()
+            with self._lock:
+                teams = list(self._subscribers)
+            for team in list(self._versions):
+                if team not in teams:
+                    del self._versions[team]
+            for team in teams:
+                try:
+                    self.check(team)
+                except (sqlite3.Error, LookupError):
+                    pass  # busy, or the team is gone: try again on the next round
+
+    def on_change(self, kind, event, details):
+        """db.change_listeners hook: writes made here don't wait for the next poll."""
+        if current_shard().name in self._subscribers:
+            self._wake.set()
+
+
+broadcaster = Broadcaster()
+change_listeners.append(broadcaster.on_change)
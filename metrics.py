@@ -0,0 +1,196 @@
+"""
+Opt-in request and SQL instrumentation, exposed in Prometheus text format on /metrics.
+
+Enable with METRICS_ENABLED=1. When it's off nothing is registered: no trace
+callback on connections and no request hooks. Numbers are per process.
+
+SQL timings come from sqlite3's trace callback, which only reports when a
+statement starts, so a statement's time runs until the next statement on that
+connection (or the end of the request) and includes fetching its rows.
+"""
+import os, threading, time
+from collections import deque
+
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "") == "1"
+# If set, /metrics requires "Authorization: Bearer <token>"
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "50"))
+SLOW_QUERY_SAMPLES = int(os.getenv("SLOW_QUERY_SAMPLES", "20"))
+
+# Timed, but not counted as queries
+CONTROL_STATEMENTS = ("BEGIN", "COMMIT", "ROLLBACK", "PRAGMA")
+
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+    def samples(self, name, labels):
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            yield f"{name}_bucket{_labels(labels, le=_number(bound))} {cumulative}"
+        yield f"{name}_bucket{_labels(labels, le='+Inf')} {self.count}"
+        yield f"{name}_sum{_labels(labels)} {_number(self.sum)}"
+        yield f"{name}_count{_labels(labels)} {self.count}"
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _labels(labels, **extra):
+    labels = {**labels, **extra}
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels.items()) + "}"
+
+
+class _RequestTrace:
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.start = time.perf_counter()
+        self.status = 500
+        self.queries = 0
+        self.statement = None
+        self.statement_start = 0.0
+
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.requests = {}        # (endpoint, method, status) -> Histogram
+        self.sql = {}             # endpoint -> Histogram
+        self.query_counts = {}    # endpoint -> int
+        self.bcrypt = {}          # operation -> Histogram
+        self.slow_queries = deque(maxlen=SLOW_QUERY_SAMPLES)
+
+    # Request lifecycle, called from the Flask hooks installed by init_app()
+    def start_request(self, endpoint):
+        self._local.trace = _RequestTrace(endpoint or "<unmatched>")
+
+    def set_status(self, status):
+        trace = getattr(self._local, "trace", None)
+        if trace is not None:
+            trace.status = status
+
+    def finish_request(self, method):
+        trace = getattr(self._local, "trace", None)
+        if trace is None:
+            return
+        self._local.trace = None
+        now = time.perf_counter()
+        self._close_statement(trace, now)
+        with self._lock:
+            key = (trace.endpoint, method, trace.status)
+            self.requests.setdefault(key, Histogram()).observe(now - trace.start)
+            self.query_counts[trace.endpoint] = self.query_counts.get(trace.endpoint, 0) + trace.queries
+
+    # SQL tracing
+    def install_trace(self, connection):
+        connection.set_trace_callback(self._trace)
+
+    def _trace(self, statement):
+        trace = getattr(self._local, "trace", None)
+        if trace is None or statement.startswith("--"):  # outside a request, or a trigger step
+            return
+        now = time.perf_counter()
+        self._close_statement(trace, now)
+        trace.statement = statement
+        trace.statement_start = now
+        if not statement.lstrip().upper().startswith(CONTROL_STATEMENTS):
+            trace.queries += 1
+
+    def _close_statement(self, trace, now):
+        if trace.statement is None:
+            return
+        elapsed = now - trace.statement_start
+        with self._lock:
+            self.sql.setdefault(trace.endpoint, Histogram()).observe(elapsed)
+            if elapsed * 1000 >= SLOW_QUERY_MS:
+                self.slow_queries.append((trace.endpoint, " ".join(trace.statement.split()), elapsed))
+        trace.statement = None
+
+    def observe_bcrypt(self, operation, seconds):
+        with self._lock:
+            self.bcrypt.setdefault(operation, Histogram()).observe(seconds)
+
+    def render(self):
+        lines = []
+        with self._lock:
+            lines += ["# HELP lunch_request_duration_seconds Time spent handling requests.",
+                      "# TYPE lunch_request_duration_seconds histogram"]
+            for (endpoint, method, status), hist in sorted(self.requests.items()):
+                lines += hist.samples("lunch_request_duration_seconds",
+                                      {"endpoint": endpoint, "method": method, "status": status})
+
+            lines += ["# HELP lunch_sql_queries_total SQL statements run while handling requests.",
+                      "# TYPE lunch_sql_queries_total counter"]
+            for endpoint, count in sorted(self.query_counts.items()):
+                lines.append(f"lunch_sql_queries_total{_labels({'endpoint': endpoint})} {count}")
+
+            lines += ["# HELP lunch_sql_duration_seconds Time per SQL statement, including fetching its rows.",
+                      "# TYPE lunch_sql_duration_seconds histogram"]
+            for endpoint, hist in sorted(self.sql.items()):
+                lines += hist.samples("lunch_sql_duration_seconds", {"endpoint": endpoint})
+
+            lines += [f"# HELP lunch_sql_slow_query_seconds Most recent statements slower than {SLOW_QUERY_MS:g}ms.",
+                      "# TYPE lunch_sql_slow_query_seconds gauge"]
+            for endpoint, statement, seconds in self.slow_queries:
+                lines.append(f"lunch_sql_slow_query_seconds"
+                             f"{_labels({'endpoint': endpoint, 'statement': statement})} {_number(seconds)}")
+
+            lines += ["# HELP lunch_bcrypt_duration_seconds Time per bcrypt operation, including queueing.",
+                      "# TYPE lunch_bcrypt_duration_seconds histogram"]
+            for operation, hist in sorted(self.bcrypt.items()):
+                lines += hist.samples("lunch_bcrypt_duration_seconds", {"operation": operation})
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+def init_app(app):
+    """Registers the hooks and the /metrics view. Does nothing unless METRICS_ENABLED=1."""
+    if not METRICS_ENABLED:
+        return
+
+    from flask import request, Response, abort
+    import db, security
+
+    db.connection_hooks.append(metrics.install_trace)
+    security.timing_hooks.append(metrics.observe_bcrypt)
+
+    @app.before_request
+    def _metrics_start():
+        metrics.start_request(request.endpoint)
+
+    @app.after_request
+    def _metrics_status(response):
+        metrics.set_status(response.status_code)
+        return response
+
+    @app.teardown_request
+    def _metrics_finish(exc):
+        metrics.finish_request(request.method)
+
+    @app.route("/metrics")
+    def metrics_view():
+        if METRICS_TOKEN and request.headers.get("Authorization") != f"Bearer {METRICS_TOKEN}":
+            return abort(401)
+        return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
@@ -0,0 +1,11 @@
+-- Databases created before user_lunch_stats existed have history the triggers never saw.
+DELETE FROM user_lunch_stats;
+
+INSERT INTO user_lunch_stats (user_id, paid, drank)
+SELECT user_id, SUM(paid), SUM(drank)
+FROM (
+    SELECT user_id, 0 AS paid, 1 AS drank FROM lunch_attendance
+    UNION ALL
+    SELECT payer_id, 1, 0 FROM lunch_events WHERE payer_id IS NOT NULL
+)
+GROUP BY user_id;
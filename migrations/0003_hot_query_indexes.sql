@@ -0,0 +1,10 @@
+-- get_by_name / exists filter on the name
+CREATE INDEX IF NOT EXISTS idx_users_name ON Users(name);
+
+-- Per-user attendance counts and the attendee join, answered from the index alone
+CREATE INDEX IF NOT EXISTS idx_attendance_user ON lunch_attendance(user_id, lunch_event_id);
+
+-- Paid counts per payer
+CREATE INDEX IF NOT EXISTS idx_events_payer ON lunch_events(payer_id);
+
+ANALYZE;
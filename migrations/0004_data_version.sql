@@ -0,0 +1,53 @@
+-- Monotonic counter bumped by every write to the lunch data. Pages derive their
+-- ETags from it, so unchanged data can be answered with 304 without querying it.
+CREATE TABLE IF NOT EXISTS data_version (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    version INTEGER NOT NULL
+);
+
+INSERT OR IGNORE INTO data_version (id, version) VALUES (1, 1);
+
+CREATE TRIGGER IF NOT EXISTS version_users_insert AFTER INSERT ON Users
+BEGIN
+    UPDATE data_version SET version = version + 1 WHERE id = 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS version_users_update AFTER UPDATE ON Users
+BEGIN
+    UPDATE data_version SET version = version + 1 WHERE id = 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS version_users_delete AFTER DELETE ON Users
+BEGIN
+    UPDATE data_version SET version = version + 1 WHERE id = 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS version_events_insert AFTER INSERT ON lunch_events
+BEGIN
+    UPDATE data_version SET version = version + 1 WHERE id = 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS version_events_update AFTER UPDATE ON lunch_events
+BEGIN
+    UPDATE data_version SET version = version + 1 WHERE id = 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS version_events_delete AFTER DELETE ON lunch_events
+BEGIN
+    UPDATE data_version SET version = version + 1 WHERE id = 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS version_attendance_insert AFTER INSERT ON lunch_attendance
+BEGIN
+    UPDATE data_version SET version = version + 1 WHERE id = 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS version_attendance_update AFTER UPDATE ON lunch_attendance
+BEGIN
+    UPDATE data_version SET version = version + 1 WHERE id = 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS version_attendance_delete AFTER DELETE ON lunch_attendance
+BEGIN
+    UPDATE data_version SET version = version + 1 WHERE id = 1;
+END;
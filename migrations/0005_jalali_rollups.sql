@@ -0,0 +1,105 @@
+-- Paid/drank per user per Jalali period, kept up to date by the triggers below.
+-- period is 'YYYY' for a year or 'YYYY-MM' for a month (prefixes of event_date).
+-- Rebuild with `flask --app app backfill-rollups`.
+CREATE TABLE IF NOT EXISTS user_period_stats (
+    period TEXT NOT NULL,
+    user_id INTEGER NOT NULL,
+    paid INTEGER DEFAULT 0 NOT NULL,
+    drank INTEGER DEFAULT 0 NOT NULL,
+    PRIMARY KEY (period, user_id),
+    FOREIGN KEY (user_id) REFERENCES Users(id)
+) WITHOUT ROWID;
+
+CREATE TRIGGER IF NOT EXISTS rollup_attendance_insert AFTER INSERT ON lunch_attendance
+BEGIN
+    INSERT INTO user_period_stats (period, user_id, drank)
+        SELECT substr(event_date, 1, 7), NEW.user_id, 1 FROM lunch_events WHERE id = NEW.lunch_event_id
+        UNION ALL
+        SELECT substr(event_date, 1, 4), NEW.user_id, 1 FROM lunch_events WHERE id = NEW.lunch_event_id
+        ON CONFLICT(period, user_id) DO UPDATE SET drank = drank + 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS rollup_attendance_delete AFTER DELETE ON lunch_attendance
+BEGIN
+    UPDATE user_period_stats SET drank = drank - 1
+    WHERE user_id = OLD.user_id AND period IN (
+        SELECT substr(event_date, 1, 7) FROM lunch_events WHERE id = OLD.lunch_event_id
+        UNION ALL
+        SELECT substr(event_date, 1, 4) FROM lunch_events WHERE id = OLD.lunch_event_id
+    );
+END;
+
+CREATE TRIGGER IF NOT EXISTS rollup_attendance_update AFTER UPDATE OF user_id, lunch_event_id ON lunch_attendance
+BEGIN
+    UPDATE user_period_stats SET drank = drank - 1
+    WHERE user_id = OLD.user_id AND period IN (
+        SELECT substr(event_date, 1, 7) FROM lunch_events WHERE id = OLD.lunch_event_id
+        UNION ALL
+        SELECT substr(event_date, 1, 4) FROM lunch_events WHERE id = OLD.lunch_event_id
+    );
+    INSERT INTO user_period_stats (period, user_id, drank)
+        SELECT substr(event_date, 1, 7), NEW.user_id, 1 FROM lunch_events WHERE id = NEW.lunch_event_id
+        UNION ALL
+        SELECT substr(event_date, 1, 4), NEW.user_id, 1 FROM lunch_events WHERE id = NEW.lunch_event_id
+        ON CONFLICT(period, user_id) DO UPDATE SET drank = drank + 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS rollup_event_insert AFTER INSERT ON lunch_events
+WHEN NEW.payer_id IS NOT NULL
+BEGIN
+    INSERT INTO user_period_stats (period, user_id, paid)
+        VALUES (substr(NEW.event_date, 1, 7), NEW.payer_id, 1), (substr(NEW.event_date, 1, 4), NEW.payer_id, 1)
+        ON CONFLICT(period, user_id) DO UPDATE SET paid = paid + 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS rollup_event_delete AFTER DELETE ON lunch_events
+WHEN OLD.payer_id IS NOT NULL
+BEGIN
+    UPDATE user_period_stats SET paid = paid - 1
+    WHERE user_id = OLD.payer_id AND period IN (substr(OLD.event_date, 1, 7), substr(OLD.event_date, 1, 4));
+END;
+
+CREATE TRIGGER IF NOT EXISTS rollup_event_payer_update AFTER UPDATE OF payer_id, event_date ON lunch_events
+WHEN OLD.payer_id IS NOT NEW.payer_id OR OLD.event_date IS NOT NEW.event_date
+BEGIN
+    UPDATE user_period_stats SET paid = paid - 1
+    WHERE user_id = OLD.payer_id AND period IN (substr(OLD.event_date, 1, 7), substr(OLD.event_date, 1, 4));
+    INSERT INTO user_period_stats (period, user_id, paid)
+        SELECT substr(NEW.event_date, 1, 7), NEW.payer_id, 1 WHERE NEW.payer_id IS NOT NULL
+        UNION ALL
+        SELECT substr(NEW.event_date, 1, 4), NEW.payer_id, 1 WHERE NEW.payer_id IS NOT NULL
+        ON CONFLICT(period, user_id) DO UPDATE SET paid = paid + 1;
+END;
+
+-- Moving a lunch to another date moves its attendance with it
+CREATE TRIGGER IF NOT EXISTS rollup_event_date_update AFTER UPDATE OF event_date ON lunch_events
+WHEN OLD.event_date IS NOT NEW.event_date
+BEGIN
+    UPDATE user_period_stats SET drank = drank - 1
+    WHERE period IN (substr(OLD.event_date, 1, 7), substr(OLD.event_date, 1, 4))
+      AND user_id IN (SELECT user_id FROM lunch_attendance WHERE lunch_event_id = NEW.id);
+    INSERT INTO user_period_stats (period, user_id, drank)
+        SELECT p.period, la.user_id, 1
+        FROM lunch_attendance la
+        JOIN (SELECT substr(NEW.event_date, 1, 7) AS period UNION ALL SELECT substr(NEW.event_date, 1, 4)) p
+        WHERE la.lunch_event_id = NEW.id
+        ON CONFLICT(period, user_id) DO UPDATE SET drank = drank + 1;
+END;
+
+-- Backfill from the existing history
+DELETE FROM user_period_stats;
+
+INSERT INTO user_period_stats (period, user_id, paid, drank)
+SELECT period, user_id, SUM(paid), SUM(drank)
+FROM (
+    SELECT substr(le.event_date, 1, 7) AS period, la.user_id, 0 AS paid, 1 AS drank
+    FROM lunch_attendance la JOIN lunch_events le ON le.id = la.lunch_event_id
+    UNION ALL
+    SELECT substr(le.event_date, 1, 4), la.user_id, 0, 1
+    FROM lunch_attendance la JOIN lunch_events le ON le.id = la.lunch_event_id
+    UNION ALL
+    SELECT substr(event_date, 1, 7), payer_id, 1, 0 FROM lunch_events WHERE payer_id IS NOT NULL
+    UNION ALL
+    SELECT substr(event_date, 1, 4), payer_id, 1, 0 FROM lunch_events WHERE payer_id IS NOT NULL
+)
+GROUP BY period, user_id;
@@ -0,0 +1,72 @@
+-- Per-table write counters next to the global data_version, so caches that only
+-- depend on some tables (like the history fragment, which ignores attendance)
+-- survive writes to the others.
+CREATE TABLE IF NOT EXISTS table_versions (
+    name TEXT PRIMARY KEY,
+    version INTEGER NOT NULL
+) WITHOUT ROWID;
+
+INSERT OR IGNORE INTO table_versions (name, version) VALUES ('Users', 1), ('lunch_events', 1), ('lunch_attendance', 1);
+
+DROP TRIGGER IF EXISTS version_users_insert;
+CREATE TRIGGER version_users_insert AFTER INSERT ON Users
+BEGIN
+    UPDATE data_version SET version = version + 1 WHERE id = 1;
+    UPDATE table_versions SET version = version + 1 WHERE name = 'Users';
+END;
+
+DROP TRIGGER IF EXISTS version_users_update;
+CREATE TRIGGER version_users_update AFTER UPDATE ON Users
+BEGIN
+    UPDATE data_version SET version = version + 1 WHERE id = 1;
+    UPDATE table_versions SET version = version + 1 WHERE name = 'Users';
+END;
+
+DROP TRIGGER IF EXISTS version_users_delete;
+CREATE TRIGGER version_users_delete AFTER DELETE ON Users
+BEGIN
+    UPDATE data_version SET version = version + 1 WHERE id = 1;
+    UPDATE table_versions SET version = version + 1 WHERE name = 'Users';
+END;
+
+DROP TRIGGER IF EXISTS version_events_insert;
+CREATE TRIGGER version_events_insert AFTER INSERT ON lunch_events
+BEGIN
+    UPDATE data_version SET version = version + 1 WHERE id = 1;
+    UPDATE table_versions SET version = version + 1 WHERE name = 'lunch_events';
+END;
+
+DROP TRIGGER IF EXISTS version_events_update;
+CREATE TRIGGER version_events_update AFTER UPDATE ON lunch_events
+BEGIN
+    UPDATE data_version SET version = version + 1 WHERE id = 1;
+    UPDATE table_versions SET version = version + 1 WHERE name = 'lunch_events';
+END;
+
+DROP TRIGGER IF EXISTS version_events_delete;
+CREATE TRIGGER version_events_delete AFTER DELETE ON lunch_events
+BEGIN
+    UPDATE data_version SET version = version + 1 WHERE id = 1;
+    UPDATE table_versions SET version = version + 1 WHERE name = 'lunch_events';
+END;
+
+DROP TRIGGER IF EXISTS version_attendance_insert;
+CREATE TRIGGER version_attendance_insert AFTER INSERT ON lunch_attendance
+BEGIN
+    UPDATE data_version SET version = version + 1 WHERE id = 1;
+    UPDATE table_versions SET version = version + 1 WHERE name = 'lunch_attendance';
+END;
+
+DROP TRIGGER IF EXISTS version_attendance_update;
+CREATE TRIGGER version_attendance_update AFTER UPDATE ON lunch_attendance
+BEGIN
+    UPDATE data_version SET version = version + 1 WHERE id = 1;
+    UPDATE table_versions SET version = version + 1 WHERE name = 'lunch_attendance';
+END;
+
+DROP TRIGGER IF EXISTS version_attendance_delete;
+CREATE TRIGGER version_attendance_delete AFTER DELETE ON lunch_attendance
+BEGIN
+    UPDATE data_version SET version = version + 1 WHERE id = 1;
+    UPDATE table_versions SET version = version + 1 WHERE name = 'lunch_attendance';
+END;
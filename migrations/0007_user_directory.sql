@@ -0,0 +1,35 @@
+-- Full-text index for the admin user directory (User.list_page). Names are
+-- stored normalized the same way as search terms (db.normalize_search): Arabic
+-- yeh/kaf become the Persian letters and zero-width non-joiners become spaces,
+-- so "علي" finds "علی" and "رضا" finds "محمد‌رضا".
+CREATE VIRTUAL TABLE IF NOT EXISTS users_fts USING fts5(
+    name,
+    display_name,
+    tokenize = 'unicode61 remove_diacritics 2',
+    prefix = '2 3'
+);
+
+DROP TRIGGER IF EXISTS users_fts_insert;
+CREATE TRIGGER users_fts_insert AFTER INSERT ON Users
+BEGIN
+    INSERT INTO users_fts (rowid, name, display_name)
+    VALUES (new.id, replace(replace(replace(new.name, char(1610), char(1740)), char(1603), char(1705)), char(8204), ' '), replace(replace(replace(new.display_name, char(1610), char(1740)), char(1603), char(1705)), char(8204), ' '));
+END;
+
+DROP TRIGGER IF EXISTS users_fts_update;
+CREATE TRIGGER users_fts_update AFTER UPDATE OF name, display_name ON Users
+BEGIN
+    DELETE FROM users_fts WHERE rowid = old.id;
+    INSERT INTO users_fts (rowid, name, display_name)
+    VALUES (new.id, replace(replace(replace(new.name, char(1610), char(1740)), char(1603), char(1705)), char(8204), ' '), replace(replace(replace(new.display_name, char(1610), char(1740)), char(1603), char(1705)), char(8204), ' '));
+END;
+
+DROP TRIGGER IF EXISTS users_fts_delete;
+CREATE TRIGGER users_fts_delete AFTER DELETE ON Users
+BEGIN
+    DELETE FROM users_fts WHERE rowid = old.id;
+END;
+
+DELETE FROM users_fts;
+INSERT INTO users_fts (rowid, name, display_name)
+SELECT id, replace(replace(replace(name, char(1610), char(1740)), char(1603), char(1705)), char(8204), ' '), replace(replace(replace(display_name, char(1610), char(1740)), char(1603), char(1705)), char(8204), ' ') FROM Users;
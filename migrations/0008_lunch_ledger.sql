@@ -0,0 +1,91 @@
+-- Append-only log of every attendance and payer change, written by the triggers
+-- below. actor_id is the signed-in user the app was serving (the ledger_actor()
+-- function db._connect() defined on its connections, NULL for CLI jobs).
+-- 0011_ledger_context.sql replaces the triggers so other connections can write.
+-- kind: 'attend' / 'leave' for user_id, 'payer' when the payer changes from
+-- previous_user_id to user_id (either may be NULL). See ledger.py.
+CREATE TABLE IF NOT EXISTS lunch_ledger (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    actor_id INTEGER,
+    kind TEXT CHECK(kind IN ('attend', 'leave', 'payer')) NOT NULL,
+    event_date TEXT,
+    user_id INTEGER,
+    previous_user_id INTEGER
+);
+
+CREATE TRIGGER IF NOT EXISTS ledger_no_update BEFORE UPDATE ON lunch_ledger
+BEGIN
+    SELECT RAISE(ABORT, 'lunch_ledger is append-only');
+END;
+
+CREATE TRIGGER IF NOT EXISTS ledger_no_delete BEFORE DELETE ON lunch_ledger
+BEGIN
+    SELECT RAISE(ABORT, 'lunch_ledger is append-only');
+END;
+
+-- Per-user totals as of ledger entry seq, so the current state is a snapshot
+-- plus the entries after it.
+CREATE TABLE IF NOT EXISTS ledger_snapshots (
+    seq INTEGER PRIMARY KEY,
+    taken_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS ledger_snapshot_totals (
+    seq INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    paid INTEGER NOT NULL,
+    drank INTEGER NOT NULL,
+    PRIMARY KEY (seq, user_id)
+) WITHOUT ROWID;
+
+CREATE TRIGGER IF NOT EXISTS ledger_attendance_insert AFTER INSERT ON lunch_attendance
+BEGIN
+    INSERT INTO lunch_ledger (actor_id, kind, event_date, user_id)
+    VALUES (ledger_actor(), 'attend', (SELECT event_date FROM lunch_events WHERE id = NEW.lunch_event_id), NEW.user_id);
+END;
+
+CREATE TRIGGER IF NOT EXISTS ledger_attendance_delete AFTER DELETE ON lunch_attendance
+BEGIN
+    INSERT INTO lunch_ledger (actor_id, kind, event_date, user_id)
+    VALUES (ledger_actor(), 'leave', (SELECT event_date FROM lunch_events WHERE id = OLD.lunch_event_id), OLD.user_id);
+END;
+
+CREATE TRIGGER IF NOT EXISTS ledger_attendance_update AFTER UPDATE OF user_id, lunch_event_id ON lunch_attendance
+BEGIN
+    INSERT INTO lunch_ledger (actor_id, kind, event_date, user_id)
+    VALUES (ledger_actor(), 'leave', (SELECT event_date FROM lunch_events WHERE id = OLD.lunch_event_id), OLD.user_id);
+    INSERT INTO lunch_ledger (actor_id, kind, event_date, user_id)
+    VALUES (ledger_actor(), 'attend', (SELECT event_date FROM lunch_events WHERE id = NEW.lunch_event_id), NEW.user_id);
+END;
+
+CREATE TRIGGER IF NOT EXISTS ledger_event_insert AFTER INSERT ON lunch_events
+WHEN NEW.payer_id IS NOT NULL
+BEGIN
+    INSERT INTO lunch_ledger (actor_id, kind, event_date, user_id)
+    VALUES (ledger_actor(), 'payer', NEW.event_date, NEW.payer_id);
+END;
+
+CREATE TRIGGER IF NOT EXISTS ledger_event_delete AFTER DELETE ON lunch_events
+WHEN OLD.payer_id IS NOT NULL
+BEGIN
+    INSERT INTO lunch_ledger (actor_id, kind, event_date, previous_user_id)
+    VALUES (ledger_actor(), 'payer', OLD.event_date, OLD.payer_id);
+END;
+
+CREATE TRIGGER IF NOT EXISTS ledger_event_payer_update AFTER UPDATE OF payer_id ON lunch_events
+WHEN OLD.payer_id IS NOT NEW.payer_id
+BEGIN
+    INSERT INTO lunch_ledger (actor_id, kind, event_date, user_id, previous_user_id)
+    VALUES (ledger_actor(), 'payer', NEW.event_date, NEW.payer_id, OLD.payer_id);
+END;
+
+-- The history recorded before the ledger existed, in date order and without an actor
+INSERT INTO lunch_ledger (kind, event_date, user_id)
+SELECT kind, event_date, user_id FROM (
+    SELECT 'payer' AS kind, event_date, payer_id AS user_id, 0 AS ord FROM lunch_events WHERE payer_id IS NOT NULL
+    UNION ALL
+    SELECT 'attend', le.event_date, la.user_id, 1
+    FROM lunch_attendance la JOIN lunch_events le ON le.id = la.lunch_event_id
+)
+ORDER BY event_date, ord, user_id;
@@ -0,0 +1,11 @@
+-- Idempotency keys of lunch page actions replayed through /api/lunch/actions.
+-- A key is recorded in the same transaction as its write (db.action_key), so a
+-- replayed action is applied at most once. Old keys are removed by
+-- `flask --app app prune-action-keys`.
+CREATE TABLE IF NOT EXISTS action_keys (
+    key TEXT PRIMARY KEY,
+    user_id INTEGER,
+    created_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS idx_action_keys_created ON action_keys(created_at);
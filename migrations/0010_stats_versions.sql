@@ -0,0 +1,5 @@
+-- Counters for the trigger-maintained stats tables. Their everyday changes come
+-- from writes to lunch_events/lunch_attendance, which already bump those
+-- counters; these only move when a table is rebuilt as a whole
+-- (db.bump_table_versions), so caches keyed on them drop the old contents.
+INSERT OR IGNORE INTO table_versions (name, version) VALUES ('user_lunch_stats', 1), ('user_period_stats', 1);
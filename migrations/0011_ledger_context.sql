@@ -0,0 +1,62 @@
+-- The ledger triggers used to ask the ledger_actor() SQL function for the
+-- actor, which only the app's connections define, so every other connection
+-- (the sqlite3 shell, repair scripts) failed its lunch writes. They now read it
+-- from this one-row table, which the app sets and clears again inside its own
+-- write transactions (db._acting), so everyone else sees NULL.
+CREATE TABLE IF NOT EXISTS ledger_context (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    actor_id INTEGER
+);
+
+INSERT OR IGNORE INTO ledger_context (id, actor_id) VALUES (1, NULL);
+
+DROP TRIGGER IF EXISTS ledger_attendance_insert;
+CREATE TRIGGER ledger_attendance_insert AFTER INSERT ON lunch_attendance
+BEGIN
+    INSERT INTO lunch_ledger (actor_id, kind, event_date, user_id)
+    VALUES ((SELECT actor_id FROM ledger_context WHERE id = 1), 'attend',
+            (SELECT event_date FROM lunch_events WHERE id = NEW.lunch_event_id), NEW.user_id);
+END;
+
+DROP TRIGGER IF EXISTS ledger_attendance_delete;
+CREATE TRIGGER ledger_attendance_delete AFTER DELETE ON lunch_attendance
+BEGIN
+    INSERT INTO lunch_ledger (actor_id, kind, event_date, user_id)
+    VALUES ((SELECT actor_id FROM ledger_context WHERE id = 1), 'leave',
+            (SELECT event_date FROM lunch_events WHERE id = OLD.lunch_event_id), OLD.user_id);
+END;
+
+DROP TRIGGER IF EXISTS ledger_attendance_update;
+CREATE TRIGGER ledger_attendance_update AFTER UPDATE OF user_id, lunch_event_id ON lunch_attendance
+BEGIN
+    INSERT INTO lunch_ledger (actor_id, kind, event_date, user_id)
+    VALUES ((SELECT actor_id FROM ledger_context WHERE id = 1), 'leave',
+            (SELECT event_date FROM lunch_events WHERE id = OLD.lunch_event_id), OLD.user_id);
+    INSERT INTO lunch_ledger (actor_id, kind, event_date, user_id)
+    VALUES ((SELECT actor_id FROM ledger_context WHERE id = 1), 'attend',
+            (SELECT event_date FROM lunch_events WHERE id = NEW.lunch_event_id), NEW.user_id);
+END;
+
+DROP TRIGGER IF EXISTS ledger_event_insert;
+CREATE TRIGGER ledger_event_insert AFTER INSERT ON lunch_events
+WHEN NEW.payer_id IS NOT NULL
+BEGIN
+    INSERT INTO lunch_ledger (actor_id, kind, event_date, user_id)
+    VALUES ((SELECT actor_id FROM ledger_context WHERE id = 1), 'payer', NEW.event_date, NEW.payer_id);
+END;
+
+DROP TRIGGER IF EXISTS ledger_event_delete;
+CREATE TRIGGER ledger_event_delete AFTER DELETE ON lunch_events
+WHEN OLD.payer_id IS NOT NULL
+BEGIN
+    INSERT INTO lunch_ledger (actor_id, kind, event_date, previous_user_id)
+    VALUES ((SELECT actor_id FROM ledger_context WHERE id = 1), 'payer', OLD.event_date, OLD.payer_id);
+END;
+
+DROP TRIGGER IF EXISTS ledger_event_payer_update;
+CREATE TRIGGER ledger_event_payer_update AFTER UPDATE OF payer_id ON lunch_events
+WHEN OLD.payer_id IS NOT NEW.payer_id
+BEGIN
+    INSERT INTO lunch_ledger (actor_id, kind, event_date, user_id, previous_user_id)
+    VALUES ((SELECT actor_id FROM ledger_context WHERE id = 1), 'payer', NEW.event_date, NEW.payer_id, OLD.payer_id);
+END;
@@ -0,0 +1,17 @@
+-- Idempotency keys are generated by the browser, so they're only unique per
+-- user: the same key from two users (say, a queue left behind in a shared
+-- browser) must not make one of them a duplicate of the other.
+CREATE TABLE action_keys_new (
+    user_id INTEGER NOT NULL,  -- 0 when no one is signed in
+    key TEXT NOT NULL,
+    created_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (user_id, key)
+) WITHOUT ROWID;
+
+INSERT INTO action_keys_new (user_id, key, created_at)
+SELECT COALESCE(user_id, 0), key, created_at FROM action_keys;
+
+DROP TABLE action_keys;
+ALTER TABLE action_keys_new RENAME TO action_keys;
+
+CREATE INDEX IF NOT EXISTS idx_action_keys_created ON action_keys(created_at);
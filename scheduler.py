@@ -0,0 +1,150 @@
+"""
+Who pays next.
+
+Attendees are kept in a heap keyed by their paid/drank ratio (lowest pays
+first, people who never drank before come first). Totals are all-time by
+default, or can be limited to a window of recent days or weighted so that
+older lunches count for less (PAYER_HALF_LIFE_DAYS). Ties are broken by a
+shuffle seeded from PAYER_SEED and the date, so the same roster on the same
+day always gets the same answer.
+"""
+import heapq, os, random
+import jdatetime
+from db import get_connection, LunchEvent
+
+PAYER_WINDOW_DAYS = int(os.getenv("PAYER_WINDOW_DAYS", "0"))
+PAYER_HALF_LIFE_DAYS = float(os.getenv("PAYER_HALF_LIFE_DAYS", "0"))
+PAYER_SEED = os.getenv("PAYER_SEED", "lunch")
+# With decay, lunches older than this many half-lives are ignored (weight < 0.1%)
+DECAY_HORIZON = 10
+
+
+def _parse(event_date):
+    return jdatetime.datetime.strptime(event_date, "%Y-%m-%d").date()
+
+def score(paid, drank):
+    """Ratio: paid / drank (avoid division by zero)."""
+    return paid / drank if drank else 0
+
+
+class PayerScheduler:
+    def __init__(self, window_days=PAYER_WINDOW_DAYS, half_life_days=PAYER_HALF_LIFE_DAYS, seed=PAYER_SEED):
+        self.window_days = window_days
+        self.half_life_days = half_life_days
+        self.seed = seed
+
+    @property
+    def all_time(self):
+        return not self.window_days and not self.half_life_days
+
+    def load_totals(self, user_ids, event_date, stats=None):
+        """
+        user_id -> (paid, drank) as of event_date, weighted per the scheduler's settings.
+        stats from LunchEvent.get_user_stats() is reused when the totals are all-time.
+        """
+        user_ids = list(user_ids)
+        if self.all_time:
+            stats = LunchEvent.get_user_stats() if stats is None else stats
+            return {u: (stats[u]['paid'], stats[u]['drank']) if u in stats else (0, 0) for u in user_ids}
+
+        today = _parse(event_date)
+        if self.half_life_days:
+            days = int(self.half_life_days * DECAY_HORIZON)
+            if self.window_days:
+                days = min(days, self.window_days)
+        else:
+            days = self.window_days
+        cutoff = (today - jdatetime.timedelta(days=days)).strftime("%Y-%m-%d")
+
+        # Grouped by Jalali month, so the rows read grow with the window, not the history
+        placeholders = ",".join("?" * len(user_ids))
+        with get_connection() as conn:
+            drank_rows = conn.execute(f"""
+                SELECT la.user_id, substr(le.event_date, 1, 7) AS month, COUNT(*) AS n
+                FROM lunch_attendance la
+                JOIN lunch_events le ON le.id = la.lunch_event_id
+                WHERE la.user_id IN ({placeholders}) AND le.event_date > ? AND le.event_date <= ?
+                GROUP BY la.user_id, month
+            """, [*user_ids, cutoff, event_date]).fetchall()
+            paid_rows = conn.execute(f"""
+                SELECT payer_id AS user_id, substr(event_date, 1, 7) AS month, COUNT(*) AS n
+                FROM lunch_events
+                WHERE payer_id IN ({placeholders}) AND event_date > ? AND event_date <= ?
+                GROUP BY payer_id, month
+            """, [*user_ids, cutoff, event_date]).fetchall()
+
+        weights = {}
+        def weight(month):
+            if not self.half_life_days:
+                return 1
+            if month not in weights:
+                year, mon = map(int, month.split("-"))
+                age = max(0, (today - jdatetime.date(year, mon, 15)).days)
+                weights[month] = 0.5 ** (age / self.half_life_days)
+            return weights[month]
+
+        paid = dict.fromkeys(user_ids, 0)
+        drank = dict.fromkeys(user_ids, 0)
+        for r in drank_rows:
+            drank[r["user_id"]] += r["n"] * weight(r["month"])
+        for r in paid_rows:
+            paid[r["user_id"]] += r["n"] * weight(r["month"])
+        return {u: (paid[u], drank[u]) for u in user_ids}
+
+    def _tiebreak(self, user_ids, event_date, step=0):
+        order = sorted(user_ids)
+        random.Random(f"{self.seed}:{event_date}:{step}").shuffle(order)
+        return {u: i for i, u in enumerate(order)}
+
+    def _heap(self, totals, tiebreak):
+        heap = [(score(*totals[u]), tiebreak[u], u) for u in totals]
+        heapq.heapify(heap)
+        return heap
+
+    def next_payer(self, attendee_ids, event_date=None, stats=None):
+        if not attendee_ids:
+            return None
+        event_date = event_date or jdatetime.date.today().strftime("%Y-%m-%d")
+        totals = self.load_totals(attendee_ids, event_date, stats)
+        return self._heap(totals, self._tiebreak(totals, event_date))[0][2]
+
+    def forecast(self, attendee_ids, n, event_date=None, stats=None):
+        """
+        The next n payers if the same people came to every lunch: after each pick
+        the payer's paid and everyone's drank go up by one.
+
+        One heap serves every step. As everyone's drank keeps growing, scores only
+        go down, so the heap is keyed by each score as of the last step, a lower
+        bound: a step pops entries until the best current score beats the bound
+        at the top, then pushes them back (the payer with one more lunch paid).
+        """
+        if not attendee_ids:
+            return []
+        event_date = event_date or jdatetime.date.today().strftime("%Y-%m-%d")
+        totals = self.load_totals(attendee_ids, event_date, stats)
+        tiebreak = self._tiebreak(totals, event_date)
+        def bound(u):
+            paid, drank = totals[u]
+            # drank 0 scores 0 whatever was paid, so 0 is its bound
+            return (score(paid, drank + n) if drank else 0, tiebreak[u], u)
+
+        heap = [bound(u) for u in totals]
+        heapq.heapify(heap)
+        payers = []
+        for step in range(n):
+            popped, best = [], None
+            while heap and (best is None or heap[0] < best):
+                u = heapq.heappop(heap)[2]
+                popped.append(u)
+                current = (score(totals[u][0], totals[u][1] + step), tiebreak[u], u)
+                best = current if best is None else min(best, current)
+            payer = best[2]
+            payers.append(payer)
+            paid, drank = totals[payer]
+            totals[payer] = (paid + 1, drank)
+            for u in popped:
+                heapq.heappush(heap, bound(u))
+        return payers
+
+
+default_scheduler = PayerScheduler()
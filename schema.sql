@@ -22,3 +22,52 @@ CREATE TABLE IF NOT EXISTS lunch_attendance (
     FOREIGN KEY (user_id) REFERENCES Users(id),
     UNIQUE(lunch_event_id, user_id)
 );
+
+-- Per-user totals kept up to date by the triggers below, so reads don't have
+-- to aggregate the whole history. Rebuild with `flask --app app rebuild-stats`.
+CREATE TABLE IF NOT EXISTS user_lunch_stats (
+    user_id INTEGER PRIMARY KEY,
+    paid INTEGER DEFAULT 0 NOT NULL,
+    drank INTEGER DEFAULT 0 NOT NULL,
+    FOREIGN KEY (user_id) REFERENCES Users(id)
+);
+
+CREATE TRIGGER IF NOT EXISTS stats_attendance_insert AFTER INSERT ON lunch_attendance
+BEGIN
+    INSERT INTO user_lunch_stats (user_id, drank) VALUES (NEW.user_id, 1)
+        ON CONFLICT(user_id) DO UPDATE SET drank = drank + 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS stats_attendance_delete AFTER DELETE ON lunch_attendance
+BEGIN
+    UPDATE user_lunch_stats SET drank = drank - 1 WHERE user_id = OLD.user_id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS stats_attendance_update AFTER UPDATE OF user_id ON lunch_attendance
+BEGIN
+    UPDATE user_lunch_stats SET drank = drank - 1 WHERE user_id = OLD.user_id;
+    INSERT INTO user_lunch_stats (user_id, drank) VALUES (NEW.user_id, 1)
+        ON CONFLICT(user_id) DO UPDATE SET drank = drank + 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS stats_event_insert AFTER INSERT ON lunch_events
+WHEN NEW.payer_id IS NOT NULL
+BEGIN
+    INSERT INTO user_lunch_stats (user_id, paid) VALUES (NEW.payer_id, 1)
+        ON CONFLICT(user_id) DO UPDATE SET paid = paid + 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS stats_event_delete AFTER DELETE ON lunch_events
+WHEN OLD.payer_id IS NOT NULL
+BEGIN
+    UPDATE user_lunch_stats SET paid = paid - 1 WHERE user_id = OLD.payer_id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS stats_event_payer_update AFTER UPDATE OF payer_id ON lunch_events
+WHEN OLD.payer_id IS NOT NEW.payer_id
+BEGIN
+    UPDATE user_lunch_stats SET paid = paid - 1 WHERE user_id = OLD.payer_id;
+    INSERT INTO user_lunch_stats (user_id, paid)
+        SELECT NEW.payer_id, 1 WHERE NEW.payer_id IS NOT NULL
+        ON CONFLICT(user_id) DO UPDATE SET paid = paid + 1;
+END;
@@ -0,0 +1,122 @@
+import os, threading, time, bcrypt, multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+# Callables run as hook(operation, seconds) after each hash/check, e.g. for metrics.
+timing_hooks = []
+
+# bcrypt work factor. Existing hashes with a different cost are upgraded on the next login.
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+# Hashing runs in worker processes so it doesn't hold the GIL or tie up request threads.
+# Set HASH_WORKERS=0 to hash inline (handy for scripts and debugging).
+HASH_WORKERS = int(os.getenv("HASH_WORKERS", str(min(4, os.cpu_count() or 1))))
+HASH_QUEUE_LIMIT = int(os.getenv("HASH_QUEUE_LIMIT", str(max(HASH_WORKERS, 1) * 8)))
+
+# Login attempts allowed per username: a burst, then LOGIN_RATE per minute.
+LOGIN_BURST = int(os.getenv("LOGIN_BURST", "5"))
+LOGIN_RATE = float(os.getenv("LOGIN_RATE", "10"))
+# Per IP the limits are larger, since a whole office may share one address.
+LOGIN_IP_BURST = int(os.getenv("LOGIN_IP_BURST", "50"))
+LOGIN_IP_RATE = float(os.getenv("LOGIN_IP_RATE", "60"))
+
+
+class HashingBusy(RuntimeError):
+    """Raised when too many hashing jobs are already queued."""
+
+
+def _hashpw(password, rounds):
+    return bcrypt.hashpw(password, bcrypt.gensalt(rounds))
+
+def _checkpw(password, hashed):
+    return bcrypt.checkpw(password, hashed)
+
+
+class HashingExecutor:
+    """Process pool for bcrypt work that refuses new jobs once queue_limit are in flight."""
+    def __init__(self, workers=HASH_WORKERS, queue_limit=HASH_QUEUE_LIMIT):
+        self.workers = workers
+        self._slots = threading.BoundedSemaphore(queue_limit)
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None:
+                # Not fork: a child forked from this multi-threaded process would
+                # inherit locks held by other threads and the open SQLite connections.
+                # forkserver (spawn on Windows) children start from a fresh interpreter.
+                methods = multiprocessing.get_all_start_methods()
+                context = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+                self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=context)
+            return self._pool
+
+    def run(self, fn, *args):
+        start = time.perf_counter()
+        if self.workers <= 0:
+            result = fn(*args)
+        else:
+            if not self._slots.acquire(blocking=False):
+                raise HashingBusy("Too many password operations in progress, try again shortly")
+            try:
+                result = self._get_pool().submit(fn, *args).result()
+            finally:
+                self._slots.release()
+        for hook in timing_hooks:
+            hook(fn.__name__.lstrip("_"), time.perf_counter() - start)
+        return result
+
+    def shutdown(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown()
+                self._pool = None
+
+
+hashing_executor = HashingExecutor()
+
+def hash_password(password):
+    return hashing_executor.run(_hashpw, password.encode("utf8"), BCRYPT_ROUNDS)
+
+def check_password(password, hashed):
+    return hashing_executor.run(_checkpw, password.encode("utf8"), hashed)
+
+def needs_rehash(hashed):
+    """True if hashed (b"$2b$<cost>$...") was made with a cost other than BCRYPT_ROUNDS."""
+    try:
+        return int(hashed.split(b"$")[2]) != BCRYPT_ROUNDS
+    except (IndexError, ValueError):
+        return False
+
+
+class LoginThrottle:
+    """Token buckets keyed by username/IP. Each attempt costs one token from every key."""
+    def __init__(self, burst=LOGIN_BURST, per_minute=LOGIN_RATE, max_keys=10000):
+        self.burst = burst
+        self.rate = per_minute / 60
+        self.max_keys = max_keys
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def _refill(self, key, now):
+        tokens, last = self._buckets.get(key, (self.burst, now))
+        return min(self.burst, tokens + (now - last) * self.rate)
+
+    def allow(self, *keys):
+        now = time.monotonic()
+        with self._lock:
+            levels = {key: self._refill(key, now) for key in keys if key}
+            if any(tokens < 1 for tokens in levels.values()):
+                return False
+            for key, tokens in levels.items():
+                self._buckets[key] = (tokens - 1, now)
+            if len(self._buckets) > self.max_keys:
+                self._prune(now)
+            return True
+
+    def _prune(self, now):
+        # Drop buckets that have refilled completely, they behave like new ones
+        for key in [k for k in self._buckets if self._refill(k, now) >= self.burst]:
+            del self._buckets[key]
+
+
+login_throttle = LoginThrottle()
+login_ip_throttle = LoginThrottle(burst=LOGIN_IP_BURST, per_minute=LOGIN_IP_RATE)
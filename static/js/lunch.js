@@ -0,0 +1,188 @@
+// Live updates: clicks are queued, shown right away and sent in the background,
+// and every open page applies the changes pushed on the event stream instead
+// of reloading. While offline the queue is kept in localStorage (per user) and
+// sent to the batch endpoint once the connection returns; each action has a key
+// the server applies at most once, so resending after a lost response is safe.
+(function () {
+    if (!window.fetch || !window.localStorage) return;  // plain form posts
+    var page = document.getElementById('lunch');
+    var today = page.dataset.today;
+    var QUEUE = 'lunch-actions:' + page.dataset.userId;  // only ever replayed by the user who queued it
+    localStorage.removeItem('lunch-actions');  // the old shared queue, its owner is unknown
+    var RETRY_MS = 15000;
+    var MAX_SERVER_ERRORS = 5;  // in a row, backing off, before giving up on a batch
+    var BATCH_SIZE = 200;  // MAX_QUEUED_ACTIONS on the server
+    var POLL_MS = 30000;
+
+    function setAttending(userId, present) {
+        var item = document.querySelector('.user-item[data-user-id="' + userId + '"]');
+        if (!item) return;
+        item.classList.toggle('attending', present);
+        var toggle = item.querySelector('[data-role="toggle"]');
+        toggle.querySelector('[name="present"]').value = present ? '0' : '1';
+        var button = toggle.querySelector('button');
+        button.className = present ? 'btn-remove' : 'btn-attend';
+        button.textContent = present ? 'Remove' : 'Present';
+        item.querySelector('[data-role="pay"]').hidden = !present;
+    }
+
+    function setPayer(userId, name) {
+        document.getElementById('todays-payer').hidden = !userId;
+        document.getElementById('todays-payer-name').textContent = name || 'Unknown';
+    }
+
+    function setStats(userId, stats) {
+        var summary = document.querySelector('.user-item[data-user-id="' + userId + '"] [data-role="summary"]');
+        if (summary) summary.textContent = '(Paid: ' + stats.paid + ' | Drank: ' + stats.drank + ')';
+        var row = document.querySelector('tr[data-user-id="' + userId + '"]');
+        if (!row) return;
+        var ratio = stats.drank > 0 ? stats.paid / stats.drank : 0;
+        row.querySelector('[data-role="paid"]').textContent = stats.paid;
+        row.querySelector('[data-role="drank"]').textContent = stats.drank;
+        var cell = row.querySelector('[data-role="ratio"]');
+        cell.textContent = ratio.toFixed(2);
+        cell.classList.toggle('low-ratio', ratio < 0.5 && stats.drank > 0);
+    }
+
+    // data: an SSE message, /api/lunch/dashboard, or the dashboard of a batch response
+    function apply(data) {
+        if (data.date !== today) return;
+        document.querySelectorAll('.user-item').forEach(function (item) {
+            setAttending(Number(item.dataset.userId), data.attendee_ids.indexOf(Number(item.dataset.userId)) !== -1);
+        });
+        Object.keys(data.stats).forEach(function (userId) { setStats(userId, data.stats[userId]); });
+        document.getElementById('next-payer').hidden = !data.next_payer;
+        document.getElementById('no-attendance').hidden = !!data.next_payer;
+        document.getElementById('next-payer-name').textContent = data.next_payer ? data.next_payer.display_name : '';
+        setPayer(data.payer_id, data.payer_name);
+        load().forEach(show);  // still unsent, so still ours to show
+    }
+
+    // Queue of actions in localStorage
+    function load() {
+        try {
+            return JSON.parse(localStorage.getItem(QUEUE)) || [];
+        } catch (e) {
+            return [];
+        }
+    }
+
+    function save(actions) {
+        localStorage.setItem(QUEUE, JSON.stringify(actions));
+    }
+
+    function newKey() {
+        if (window.crypto && crypto.randomUUID) return crypto.randomUUID();
+        return Date.now().toString(36) + '-' + Math.random().toString(36).slice(2);
+    }
+
+    function show(action) {
+        if (action.date !== today) return;
+        if (action.action === 'attendance') {
+            setAttending(action.user_id, action.present);
+        } else {
+            var item = document.querySelector('.user-item[data-user-id="' + action.payer_id + '"]');
+            setPayer(action.payer_id, item && item.dataset.name);
+        }
+    }
+
+    var sending = false;
+    var serverErrors = 0;
+    function flush() {
+        var actions = load().slice(0, BATCH_SIZE);
+        if (sending || !actions.length) return;
+        sending = true;
+        fetch(page.dataset.actionsUrl, {
+            method: 'POST',
+            body: JSON.stringify({actions: actions}),
+            headers: {'Content-Type': 'application/json'},
+            credentials: 'same-origin'
+        }).then(function (response) {
+            if (response.redirected || response.status === 401) {
+                location.reload();  // signed out: the login page will show
+                return;
+            }
+            if (response.status === 400) {
+                save([]);  // a batch the server will never take, start over from its state
+                location.reload();
+                return;
+            }
+            if (response.status >= 500) {
+                sending = false;
+                if (++serverErrors < MAX_SERVER_ERRORS) {
+                    setTimeout(flush, RETRY_MS * Math.pow(2, serverErrors - 1));
+                    return;
+                }
+                serverErrors = 0;  // the server keeps failing on this batch: drop it
+                save(load().slice(actions.length));
+                location.reload();
+                return;
+            }
+            if (!response.ok) throw new Error(response.status);
+            serverErrors = 0;
+            return response.json().then(function (data) {
+                var done = {};
+                data.results.forEach(function (result) { done[result.key] = true; });
+                save(load().filter(function (action) { return !done[action.key]; }));
+                apply(data.dashboard);
+                sending = false;
+                flush();  // anything queued meanwhile, or past BATCH_SIZE
+            });
+        }).catch(function () {
+            sending = false;
+            setTimeout(flush, RETRY_MS);  // offline or server trouble, keep the queue
+        });
+    }
+
+    document.querySelectorAll('.user-item form').forEach(function (form) {
+        form.addEventListener('submit', function (e) {
+            e.preventDefault();
+            var action = {key: newKey(), date: today};
+            if (form.dataset.role === 'toggle') {
+                action.action = 'attendance';
+                action.user_id = Number(form.querySelector('[name="user_id"]').value);
+                action.present = form.querySelector('[name="present"]').value === '1';
+            } else {
+                action.action = 'payer';
+                action.payer_id = Number(form.querySelector('[name="payer_id"]').value);
+            }
+            save(load().concat([action]));
+            show(action);
+            flush();
+        });
+    });
+    window.addEventListener('online', flush);
+
+    if (navigator.serviceWorker) {
+        navigator.serviceWorker.register(page.dataset.serviceWorker, {scope: '/'});
+    }
+    // This copy may be the service worker's from an earlier visit: bring it up
+    // to date from the dashboard (live, or the last one cached) and the queue
+    fetch(page.dataset.dashboardUrl, {credentials: 'same-origin'}).then(function (response) {
+        return response.ok && !response.redirected ? response.json().then(apply) : null;
+    }).catch(function () {
+        load().forEach(show);
+    });
+    flush();
+
+    // Without the event stream (unsupported, or the server is serving too many)
+    // the dashboard is fetched every POLL_MS instead
+    function poll() {
+        setInterval(function () {
+            fetch(page.dataset.dashboardUrl, {credentials: 'same-origin'}).then(function (response) {
+                return response.ok && !response.redirected ? response.json().then(apply) : null;
+            }).catch(function () {});
+        }, POLL_MS);
+    }
+    if (!window.EventSource) return poll();
+    var stream = new EventSource(page.dataset.streamUrl);
+    var connected = false;
+    stream.addEventListener('dashboard', function (event) { apply(JSON.parse(event.data)); });
+    stream.addEventListener('open', function () {
+        if (connected) location.reload();  // reconnected, we may have missed changes
+        connected = true;
+    });
+    stream.addEventListener('error', function () {
+        if (stream.readyState === EventSource.CLOSED) poll();  // refused (503), not a dropped connection
+    });
+})();
@@ -0,0 +1,64 @@
+// Service worker for the lunch page: keeps the last copy of the page, its
+// dashboard JSON and the static files it uses, so the page still opens when
+// the network is down. Queued actions are replayed by lunch.js, not here.
+// Registered as /sw.js?user=<id>: another user signing in on this browser
+// installs a new worker, which drops the previous user's cache.
+var CACHE = 'lunch-v1-' + new URL(location.href).searchParams.get('user');
+var PAGES = ['/lunch', '/api/lunch/dashboard'];
+
+self.addEventListener('install', function () {
+    self.skipWaiting();
+});
+
+self.addEventListener('activate', function (event) {
+    event.waitUntil(caches.keys().then(function (names) {
+        return Promise.all(names.filter(function (name) { return name !== CACHE; })
+                                .map(function (name) { return caches.delete(name); }));
+    }).then(function () { return self.clients.claim(); }));
+});
+
+// Page and dashboard: network first, the last good copy when offline
+function networkFirst(request, key) {
+    return fetch(request).then(function (response) {
+        if (response.ok && !response.redirected) {
+            var copy = response.clone();
+            caches.open(CACHE).then(function (cache) { cache.put(key, copy); });
+        }
+        return response;
+    }).catch(function () {
+        return caches.match(key).then(function (cached) { return cached || Response.error(); });
+    });
+}
+
+// Fingerprinted static files never change under the same URL: cache first,
+// dropping older versions of the same file
+function cacheFirst(request) {
+    return caches.match(request).then(function (cached) {
+        return cached || fetch(request).then(function (response) {
+            if (response.ok) {
+                var copy = response.clone();
+                caches.open(CACHE).then(function (cache) {
+                    var path = new URL(request.url).pathname;
+                    return cache.keys().then(function (keys) {
+                        keys.forEach(function (key) {
+                            if (new URL(key.url).pathname === path) cache.delete(key);
+                        });
+                        return cache.put(request, copy);
+                    });
+                });
+            }
+            return response;
+        });
+    });
+}
+
+self.addEventListener('fetch', function (event) {
+    var request = event.request;
+    var url = new URL(request.url);
+    if (request.method !== 'GET' || url.origin !== location.origin) return;
+    if (PAGES.indexOf(url.pathname) !== -1) {
+        event.respondWith(networkFirst(request, url.pathname));
+    } else if (url.pathname.indexOf('/static/') === 0 && url.searchParams.has('v')) {
+        event.respondWith(cacheFirst(request));
+    }
+});
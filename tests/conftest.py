@@ -0,0 +1,55 @@
+import itertools
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+import pytest
+
+# Configure before the app modules read the environment at import time
+_workdir = tempfile.mkdtemp(prefix="lunch-tests-")
+os.environ["DB_PATH"] = str(Path(_workdir) / "test.sqlite")
+os.environ["TEAMS_DIR"] = str(Path(_workdir) / "teams")
+os.environ["TEAM_DOMAIN"] = "lunch.test"
+os.environ.setdefault("HASH_WORKERS", "0")
+os.environ.setdefault("BCRYPT_ROUNDS", "4")
+os.environ.setdefault("LOGIN_BURST", "1000")
+os.environ.setdefault("LOGIN_IP_BURST", "1000")
+os.environ.setdefault("METRICS_ENABLED", "1")
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+import app as app_module
+from db import User, release_connection
+
+PASSWORD = "secret"
+_names = itertools.count()
+
+
+@pytest.fixture(scope="session")
+def app():
+    app_module.startup()
+    app_module.app.config["TESTING"] = True
+    return app_module.app
+
+
+@pytest.fixture
+def make_user(app):
+    def make(role="user", active=True):
+        user = User(name=f"user{next(_names)}", role=role, password=PASSWORD)
+        user._active = active
+        user.save()
+        release_connection()
+        return User.get_by_name(user.name)
+    return make
+
+
+@pytest.fixture
+def login(app):
+    def login(user, host="localhost"):
+        """A client signed in as user; pass host (e.g. acme.lunch.test) to sign in to another team."""
+        client = app.test_client()
+        response = client.post("/account/login", data={"username": user.name, "password": PASSWORD},
+                               headers={"Host": host})
+        assert response.status_code == 302
+        return client
+    return login
@@ -0,0 +1,60 @@
+from db import LunchEvent
+
+
+def test_unknown_user_is_an_error_not_applied(make_user, login):
+    client = login(make_user(role="admin"))
+    today = client.get("/api/lunch/dashboard").get_json()["date"]
+    response = client.post("/api/lunch/actions", json={"actions": [
+        {"key": "attend-unknown", "date": today, "action": "attendance", "user_id": 999999, "present": True},
+        {"key": "pay-unknown", "date": today, "action": "payer", "payer_id": 999999},
+    ]})
+    assert response.status_code == 200
+    assert [r["status"] for r in response.get_json()["results"]] == ["error", "error"]
+    assert 999999 not in response.get_json()["dashboard"]["attendee_ids"]
+
+
+def test_toggle_unknown_user_is_a_bad_request(make_user, login):
+    client = login(make_user())
+    response = client.post("/lunch", data={"action": "toggle_attendance", "user_id": "999999"})
+    assert response.status_code == 400
+
+
+def test_only_admins_set_other_days(make_user, login):
+    user = make_user()
+    body = {"date": "1400-01-03", "attendees": [user.id]}
+    assert login(user).put("/api/lunch/attendance", json=body).status_code == 403
+    assert login(make_user(role="admin")).put("/api/lunch/attendance", json=body).status_code == 200
+    assert login(user).put("/api/lunch/attendance", json={"attendees": [user.id]}).status_code == 200
+
+
+def test_roster_dates_are_normalized(make_user, login):
+    user = make_user()
+    today = login(user).get("/api/lunch/dashboard").get_json()["date"]
+    year, month, day = map(int, today.split("-"))
+    response = login(user).put("/api/lunch/attendance", json={"date": f"{year}-{month}-{day}", "attendees": [user.id]})
+    assert response.status_code == 200
+    assert response.get_json()["date"] == today
+
+
+def test_only_admins_act_on_other_days(make_user, login):
+    user = make_user()
+    response = login(user).post("/api/lunch/actions", json={"actions": [
+        {"key": "old-payer", "date": "1399-01-05", "action": "payer", "payer_id": user.id},
+    ]})
+    assert [r["status"] for r in response.get_json()["results"]] == ["error"]
+    assert LunchEvent.get_by_date("1399-01-05") is None
+
+
+def test_action_keys_are_per_user(make_user, login):
+    today = login(make_user()).get("/api/lunch/dashboard").get_json()["date"]
+    statuses = []
+    for user in (make_user(), make_user()):
+        action = {"key": "shared-key", "date": today, "action": "attendance", "user_id": user.id, "present": True}
+        response = login(user).post("/api/lunch/actions", json={"actions": [action]})
+        statuses += [r["status"] for r in response.get_json()["results"]]
+    assert statuses == ["applied", "applied"]
+
+
+def test_logout_clears_the_browser_state(make_user, login):
+    response = login(make_user()).post("/account/logout")
+    assert response.headers["Clear-Site-Data"] == '"cache", "storage"'
@@ -0,0 +1,42 @@
+import sqlite3
+
+from db import DB_PATH, User
+from security import LoginThrottle
+
+
+def test_deactivated_session_is_signed_out(make_user, login):
+    user = make_user()
+    client = login(user)
+    assert client.get("/lunch").status_code == 200
+
+    user.deactivate()
+    response = client.get("/lunch")
+    assert response.status_code == 302
+    assert "/account/login" in response.headers["Location"]
+
+
+def test_identity_cache_sees_other_processes(app, make_user):
+    user = make_user()
+    assert User.get_identity(user.id).is_active
+
+    # Another worker's write: nothing in this process invalidates the cache
+    with sqlite3.connect(DB_PATH) as conn:
+        conn.execute("UPDATE users SET active=0 WHERE id=?", [user.id])
+    assert not User.get_identity(user.id).is_active
+
+
+def test_login_is_throttled_per_address(app, make_user, monkeypatch):
+    monkeypatch.setattr("app.login_ip_throttle", LoginThrottle(burst=2, per_minute=0))
+    client = app.test_client()
+    statuses = [client.post("/account/login", data={"username": make_user().name, "password": "wrong"}).status_code
+                for _ in range(3)]
+    assert statuses == [200, 200, 429]  # different users, one address
+
+
+def test_forwarded_for_is_ignored_without_trusted_proxies(app, make_user, monkeypatch):
+    monkeypatch.setattr("app.login_ip_throttle", LoginThrottle(burst=2, per_minute=0))
+    client = app.test_client()
+    statuses = [client.post("/account/login", data={"username": make_user().name, "password": "wrong"},
+                            headers={"X-Forwarded-For": f"10.0.0.{i}"}).status_code
+                for i in range(3)]
+    assert statuses == [200, 200, 429]
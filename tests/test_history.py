@@ -0,0 +1,47 @@
+import io
+
+import pytest
+
+import history
+from db import LunchEvent
+
+
+def records(text):
+    return list(history.read_records(io.StringIO(text), "jsonl"))
+
+
+def test_read_jsonl():
+    assert records('{"date": "1402-01-15", "payer": "ali", "attendees": ["ali", "sara"]}\n\n') == [
+        (1, {"date": "1402-01-15", "payer": "ali", "attendees": ["ali", "sara"]}),
+    ]
+
+
+@pytest.mark.parametrize("line", [
+    '["1402-01-15", "ali"]',
+    '"1402-01-15"',
+    '{"date": "1402-01-15", "attendees": "ali"}',
+    '{"date": "1402-01-15", "attendees": [1, 2]}',
+    '{"date": "1402-01-15", "payer": 7}',
+])
+def test_read_jsonl_rejects_malformed_records(line):
+    with pytest.raises(ValueError, match="^Line 2:"):
+        records('{"date": "1402-01-14"}\n' + line + "\n")
+
+
+def test_import_stores_normalized_dates(make_user):
+    user = make_user()
+    summary = LunchEvent.import_records([
+        (1, {"date": "1398-1-5", "payer": user.name, "attendees": [user.name]}),
+        (2, {"date": "1398-01-05", "payer": None, "attendees": [user.name]}),
+    ])
+    assert summary["skipped"] == []
+    assert LunchEvent.get_by_date("1398-01-05").payer_id == user.id
+    assert "1398-1-" not in LunchEvent.list_periods()
+
+
+def test_history_filters_are_normalized(make_user, login):
+    user = make_user(role="admin")
+    for day in ("1397-01-05", "1397-02-01"):
+        LunchEvent.get_or_create_by_date(day).add_attendee(user.id)
+    events = login(user).get("/api/lunch/history?start=1397-1-1&end=1397-1-31").get_json()["events"]
+    assert [e["date"] for e in events] == ["1397-01-05"]
@@ -0,0 +1,29 @@
+import sqlite3
+
+import ledger
+from db import DB_PATH, LunchEvent, get_connection, set_actor
+
+
+def last_entry():
+    return dict(get_connection().execute("SELECT * FROM lunch_ledger ORDER BY seq DESC LIMIT 1").fetchone())
+
+
+def test_ledger_records_the_actor(make_user):
+    admin, user = make_user(role="admin"), make_user()
+    event = LunchEvent.get_or_create_by_date("1396-01-01")
+    set_actor(admin.id)
+    try:
+        event.add_attendee(user.id)
+    finally:
+        set_actor(None)
+    assert (last_entry()["kind"], last_entry()["actor_id"], last_entry()["user_id"]) == ("attend", admin.id, user.id)
+    assert get_connection().execute("SELECT actor_id FROM ledger_context").fetchone()["actor_id"] is None
+
+
+def test_other_connections_can_write(make_user):
+    user = make_user()
+    event = LunchEvent.get_or_create_by_date("1396-01-02")
+    with sqlite3.connect(DB_PATH) as conn:  # no app functions registered
+        conn.execute("INSERT INTO lunch_attendance (lunch_event_id, user_id) VALUES (?, ?)", [event.id, user.id])
+    assert (last_entry()["kind"], last_entry()["actor_id"]) == ("attend", None)
+    assert ledger.verify() == {}
@@ -0,0 +1,30 @@
+import json
+import sqlite3
+
+import jdatetime
+
+import live
+from db import DB_PATH, DEFAULT_TEAM, LunchEvent
+
+
+def test_streams_are_capped(make_user, login, monkeypatch):
+    monkeypatch.setattr(live, "broadcaster", live.Broadcaster(max_streams=0))
+    response = login(make_user()).get("/lunch/stream")
+    assert response.status_code == 503
+    assert "Retry-After" in response.headers
+
+
+def test_writes_from_other_processes_are_published(make_user):
+    broadcaster = live.Broadcaster(poll_seconds=3600)
+    q = broadcaster.subscribe(DEFAULT_TEAM)
+    broadcaster.check(DEFAULT_TEAM)  # the version the page was loaded at
+    assert q.empty()
+
+    user = make_user()
+    event = LunchEvent.get_or_create_by_date(jdatetime.date.today().strftime("%Y-%m-%d"))
+    with sqlite3.connect(DB_PATH) as conn:  # another worker's write
+        conn.execute("INSERT INTO lunch_attendance (lunch_event_id, user_id) VALUES (?, ?)", [event.id, user.id])
+    broadcaster.check(DEFAULT_TEAM)
+    event_type, data = q.get_nowait().splitlines()[:2]
+    assert event_type == "event: dashboard"
+    assert user.id in json.loads(data[len("data: "):])["attendee_ids"]
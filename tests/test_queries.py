@@ -0,0 +1,27 @@
+from db import LunchDashboard, LunchEvent
+from metrics import metrics
+from scheduler import default_scheduler
+
+
+def lunch_queries(client):
+    before = metrics.query_counts.get("lunch", 0)
+    assert client.get("/lunch").status_code == 200
+    return metrics.query_counts["lunch"] - before
+
+
+def test_dashboard_query_count(make_user):
+    user = make_user()
+    LunchEvent.get_or_create_by_date("1400-02-01").add_attendee(user.id)
+    assert LunchDashboard("1400-02-01").query_count <= 2
+    assert LunchDashboard("1400-02-01", recent_limit=0).query_count == 1
+
+
+def test_lunch_page_query_count(make_user, login):
+    user = make_user()
+    client = login(user)
+    client.post("/lunch", data={"action": "toggle_attendance", "user_id": user.id, "present": "1"})
+    lunch_queries(client)  # fills the identity and fragment caches
+    # Users version (identity cache), data_version (ETag), table versions
+    # (fragment keys) and the dashboard. All-time payer totals come from the
+    # dashboard's stats, windowed or decayed ones take two more queries.
+    assert lunch_queries(client) == (4 if default_scheduler.all_time else 6)
@@ -0,0 +1,31 @@
+import random
+
+import pytest
+
+from scheduler import PayerScheduler, score
+
+
+def rescored_forecast(scheduler, totals, n, event_date):
+    """Forecast by scoring everyone again at every step."""
+    tiebreak = scheduler._tiebreak(totals, event_date)
+    payers = []
+    for _ in range(n):
+        payer = min(totals, key=lambda u: (score(*totals[u]), tiebreak[u], u))
+        payers.append(payer)
+        totals = {u: (paid + (u == payer), drank + 1) for u, (paid, drank) in totals.items()}
+    return payers
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_forecast_matches_rescoring_every_step(seed):
+    rng = random.Random(seed)
+    totals = {}
+    for user_id in range(1, rng.randint(2, 8)):
+        drank = rng.choice([0, rng.randint(1, 30)])
+        totals[user_id] = (rng.randint(0, drank), drank)
+    scheduler = PayerScheduler(seed="test")
+    scheduler.load_totals = lambda user_ids, event_date, stats=None: dict(totals)
+
+    forecast = scheduler.forecast(list(totals), 12, "1403-01-01")
+    assert forecast == rescored_forecast(scheduler, totals, 12, "1403-01-01")
+    assert forecast[0] == scheduler.next_payer(list(totals), "1403-01-01")
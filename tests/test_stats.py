@@ -0,0 +1,39 @@
+import ledger
+from db import LunchEvent, get_connection, get_data_version, get_table_versions
+
+
+def test_rebuild_user_stats_matches_history(make_user):
+    user = make_user()
+    event = LunchEvent.get_or_create_by_date("1400-01-01")
+    event.add_attendee(user.id)
+    event.set_payer(user.id)
+    with get_connection() as conn:
+        conn.execute("UPDATE user_lunch_stats SET paid=0, drank=0 WHERE user_id=?", [user.id])
+
+    LunchEvent.rebuild_user_stats()
+    assert not get_connection().in_transaction
+    assert LunchEvent.verify_user_stats() == {}
+
+
+def test_rebuilds_bump_the_versions(make_user):
+    before = get_table_versions()
+    data_version = get_data_version()
+    LunchEvent.rebuild_user_stats()
+    LunchEvent.rebuild_period_stats()
+    after = get_table_versions()
+    assert after["user_lunch_stats"] > before["user_lunch_stats"]
+    assert after["user_period_stats"] > before["user_period_stats"]
+    assert get_data_version() > data_version
+
+
+def test_rebuild_stats_from_ledger(make_user):
+    user = make_user()
+    event = LunchEvent.get_or_create_by_date("1400-01-02")
+    event.add_attendee(user.id)
+    with get_connection() as conn:
+        conn.execute("UPDATE user_lunch_stats SET drank=drank+5 WHERE user_id=?", [user.id])
+    assert user.id in ledger.verify()
+
+    ledger.rebuild_stats(full=True)
+    assert ledger.verify(full=True) == {}
+    assert LunchEvent.verify_user_stats() == {}
@@ -0,0 +1,75 @@
+import pytest
+
+from app import app as flask_app
+from db import LunchEvent, create_team, default_shard, get_shard, release_connection, use_shard
+
+TEAM_HOST = "acme.lunch.test"
+ON_TEAM = {"Host": TEAM_HOST}  # the test client keeps each host's session cookie apart
+
+
+@pytest.fixture(scope="module")
+def team(app):
+    try:
+        get_shard("acme")
+    except LookupError:
+        create_team("acme")
+    return "acme"
+
+
+@pytest.fixture
+def make_team_user(team, make_user):
+    def make(role="user"):
+        with use_shard(team):
+            return make_user(role)
+    return make
+
+
+def test_unknown_team_is_not_found(app):
+    client = app.test_client()
+    assert client.get("/account/login", headers={"Host": "nope.lunch.test"}).status_code == 404
+
+
+def test_users_sign_in_to_their_own_team(app, make_team_user):
+    user = make_team_user()
+    data = {"username": user.name, "password": "secret"}
+    assert app.test_client().post("/account/login", data=data).status_code == 200  # not found on the default team
+    assert app.test_client().post("/account/login", data=data, headers=ON_TEAM).status_code == 302
+
+
+def test_identity_and_directory_come_from_the_team(make_user, make_team_user, login):
+    admin = make_team_user("admin")
+    other = make_user()
+    client = login(admin, host=TEAM_HOST)
+    names = {u["name"] for u in client.get("/api/admin/users", headers=ON_TEAM).get_json()["users"]}
+    assert admin.name in names and other.name not in names
+    assert get_shard("acme").identity_cache is not default_shard.identity_cache
+
+
+def test_cached_pages_are_per_team(make_user, make_team_user, login):
+    user = make_user()
+    team_user = make_team_user()
+    team_client, client = login(team_user, host=TEAM_HOST), login(user)
+    for _ in range(2):  # the second round is served from each team's fragment cache
+        team_page = team_client.get("/lunch", headers=ON_TEAM).get_data(as_text=True)
+        page = client.get("/lunch").get_data(as_text=True)
+        assert team_user.display_name in team_page and user.display_name not in team_page
+        assert user.display_name in page and team_user.display_name not in page
+
+
+def test_export_is_per_team(make_user, make_team_user, login):
+    admin = make_team_user("admin")
+    with use_shard("acme"):
+        LunchEvent.get_or_create_by_date("1399-12-29").add_attendee(admin.id)
+    release_connection()
+    team_export = login(admin, host=TEAM_HOST).get("/admin/history/export", headers=ON_TEAM).get_data(as_text=True)
+    export = login(make_user("admin")).get("/admin/history/export").get_data(as_text=True)
+    assert "1399-12-29" in team_export and "1399-12-29" not in export
+
+
+def test_team_stats_lists_every_team(team, make_team_user):
+    make_team_user()
+    result = flask_app.test_cli_runner().invoke(args=["team-stats"])
+    assert result.exit_code == 0, result.output
+    rows = [line.split()[0] for line in result.output.splitlines()[1:]]
+    assert rows[:2] == ["default", "acme"]
+    assert result.output.splitlines()[-1].startswith("all teams")
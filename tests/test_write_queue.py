@@ -0,0 +1,59 @@
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import db
+from db import DB_PATH, LunchEvent, WriteQueue, release_connection
+
+
+@pytest.fixture
+def write_queue(app, monkeypatch):
+    monkeypatch.setattr(db, "DB_WRITE_QUEUE", True)
+    queue = WriteQueue(DB_PATH)
+    yield queue
+    queue.shutdown()
+
+
+def insert_event(event_date):
+    def write(conn):
+        return conn.execute("INSERT INTO lunch_events (event_date) VALUES (?) RETURNING id", [event_date]).fetchone()[0]
+    return write
+
+
+def test_failed_write_does_not_undo_its_batch(write_queue):
+    release = threading.Event()
+    blocker = write_queue.submit(lambda conn: release.wait(5))
+    # Queued behind the blocker, so the writer takes all three as one batch
+    first = write_queue.submit(insert_event("1395-01-01"))
+    failing = write_queue.submit(insert_event("1395-01-01"))  # same date: UNIQUE constraint
+    last = write_queue.submit(insert_event("1395-01-02"))
+    release.set()
+
+    assert blocker.result() is True
+    with pytest.raises(sqlite3.IntegrityError):
+        failing.result()
+    # Resolved after the commit: another connection already sees both rows
+    with sqlite3.connect(DB_PATH) as conn:
+        rows = dict(conn.execute(
+            "SELECT event_date, id FROM lunch_events WHERE event_date IN ('1395-01-01', '1395-01-02')"
+        ).fetchall())
+    assert rows == {"1395-01-01": first.result(), "1395-01-02": last.result()}
+
+
+def test_concurrent_get_or_create_returns_one_event(app, monkeypatch):
+    monkeypatch.setattr(db, "DB_WRITE_QUEUE", True)
+
+    def get_or_create(_):
+        try:
+            return LunchEvent.get_or_create_by_date("1395-02-01").id
+        finally:
+            release_connection()
+
+    try:
+        with ThreadPoolExecutor(8) as pool:
+            ids = set(pool.map(get_or_create, range(32)))
+    finally:
+        db.default_shard.write_queue.shutdown()
+    assert len(ids) == 1